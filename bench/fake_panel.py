@@ -0,0 +1,198 @@
+"""پنل X-UI ساختگی برای تست بار و بنچمارک
+
+یک Process چند پنل مستقل را روی پورت‌های پشت سر هم اجرا می‌کند (هر پورت = یک سرور با سشن‌های خودش).
+مسیرها: POST /login، POST /server/status، GET / (صفحه لاگین با نسخه) و همه مسیرهای POSSIBLE_PATHS برای دانلود دیتابیس.
+
+python bench/fake_panel.py --port 21000 --count 100 --latency 50 --fail-rate 0.02 --auth-expiry 60 --db-size 4MB
+بعد از آماده شدن یک خط «READY <port> <count> <db bytes>» چاپ می‌شود.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import secrets
+import sqlite3
+import sys
+import tempfile
+import time
+from urllib.parse import parse_qs
+
+# همان مسیرهای main.POSSIBLE_PATHS (بدون import کردن main که به config.py نیاز دارد)
+DB_PATHS = ["/panel/api/server/getDb", "/server/getDb", "/xui/server/getDb", "/api/server/getDb"]
+CHUNK_SIZE = 64 * 1024
+REASONS = {200: "OK", 206: "Partial Content", 401: "Unauthorized", 404: "Not Found", 500: "Internal Server Error"}
+
+
+def parse_size(text):
+    text = text.strip().upper()
+    for suffix, factor in (('GB', 1024 ** 3), ('MB', 1024 ** 2), ('KB', 1024), ('B', 1)):
+        if text.endswith(suffix): return int(float(text[:-len(suffix)]) * factor)
+    return int(text)
+
+
+def build_database(size, inbounds=20, clients_per_inbound=50):
+    """دیتابیس SQLite شبیه x-ui با جداول inbounds و client_traffics؛ با یک جدول پرکننده به حجم تقریبی size می‌رسد"""
+    fd, path = tempfile.mkstemp(suffix='.db', prefix='fake-xui-')
+    os.close(fd)
+    conn = sqlite3.connect(path)
+    conn.executescript("""
+        CREATE TABLE inbounds (id INTEGER PRIMARY KEY, up INTEGER, down INTEGER, remark TEXT, port INTEGER, protocol TEXT, settings TEXT);
+        CREATE TABLE client_traffics (id INTEGER PRIMARY KEY, inbound_id INTEGER, email TEXT, up INTEGER, down INTEGER);
+        CREATE TABLE padding (data BLOB);
+    """)
+    for i in range(inbounds):
+        clients = [{'id': secrets.token_hex(16), 'email': f"user{i}_{c}"} for c in range(clients_per_inbound)]
+        conn.execute("INSERT INTO inbounds (up, down, remark, port, protocol, settings) VALUES (?, ?, ?, ?, ?, ?)",
+                     (random.randint(0, 10 ** 10), random.randint(0, 10 ** 11), f"inbound-{i}", 10000 + i, 'vless', json.dumps({'clients': clients})))
+        conn.executemany("INSERT INTO client_traffics (inbound_id, email, up, down) VALUES (?, ?, ?, ?)",
+                         [(i + 1, c['email'], random.randint(0, 10 ** 9), random.randint(0, 10 ** 10)) for c in clients])
+    conn.commit()
+    current = os.path.getsize(path)
+    # داده تصادفی تا فشرده‌سازی و دلتا نتایج غیرواقعی ندهند
+    while current < size:
+        conn.executemany("INSERT INTO padding VALUES (?)", [(os.urandom(4000),) for _ in range(min(256, (size - current) // 4000 + 1))])
+        conn.commit()
+        current = os.path.getsize(path)
+    conn.close()
+    with open(path, 'rb') as f: data = f.read()
+    os.remove(path)
+    return data
+
+
+class FakePanel:
+    """یک پنل روی یک پورت؛ سشن‌ها مستقل از بقیه پنل‌ها هستند"""
+
+    def __init__(self, options, database):
+        self.options = options
+        self.database = database
+        self.sessions = {}
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                head = await reader.readuntil(b'\r\n\r\n')
+                lines = head.decode('latin-1').split('\r\n')
+                method, target, _ = lines[0].split(' ', 2)
+                headers = {}
+                for line in lines[1:]:
+                    if ':' in line:
+                        key, value = line.split(':', 1)
+                        headers[key.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0) or 0))
+                if not await self.respond(writer, method, target.split('?', 1)[0], headers, body): return
+                if headers.get('connection', '').lower() == 'close': return
+        except (ConnectionError, asyncio.IncompleteReadError):
+            # کلاینت درخواست را لغو کرده (مثلاً Probeهای مسیر بعد از پیدا شدن مسیر درست)
+            return
+        finally:
+            writer.close()
+
+    async def respond(self, writer, method, path, headers, body):
+        options = self.options
+        if options.latency: await asyncio.sleep(max(0.0, random.gauss(options.latency, options.jitter)) / 1000)
+        if options.fail_rate and random.random() < options.fail_rate:
+            # نیمی از خطاها 500 و نیمی قطع ناگهانی اتصال
+            if random.random() < 0.5: return False
+            await self.send(writer, 500, b'{"success":false,"msg":"internal error"}')
+            return True
+
+        if method == 'POST' and path == '/login':
+            form = parse_qs(body.decode(errors='replace'))
+            if form.get('username', [''])[0] == options.username and form.get('password', [''])[0] == options.password:
+                token = secrets.token_hex(16)
+                self.sessions[token] = time.monotonic()
+                await self.send(writer, 200, b'{"success":true,"msg":"Login Successfully","obj":null}',
+                                extra={'Set-Cookie': f"session={token}; Path=/; HttpOnly"})
+            else:
+                await self.send(writer, 200, b'{"success":false,"msg":"Invalid username or password","obj":null}')
+            return True
+
+        if method == 'GET' and path == '/':
+            page = f'<html><head><title>3x-ui</title><script src="/assets/vue/vue.min.js?{options.version}"></script></head><body>login</body></html>'
+            await self.send(writer, 200, page.encode(), content_type='text/html; charset=utf-8')
+            return True
+
+        if not self.authorized(headers):
+            await self.send(writer, 404 if options.expired_status == 404 else 401, b'')
+            return True
+
+        if method == 'POST' and path == '/server/status':
+            status = {'cpu': round(random.uniform(1, 90), 1), 'mem': {'current': random.randint(200, 900) * 2 ** 20, 'total': 1024 * 2 ** 20},
+                      'uptime': int(time.monotonic()), 'xray': {'state': 'running', 'version': '1.8.4'}}
+            await self.send(writer, 200, json.dumps({'success': True, 'msg': '', 'obj': status}).encode())
+            return True
+
+        if method in ('GET', 'HEAD') and path in options.db_paths:
+            await self.send_database(writer, headers, head_only=method == 'HEAD')
+            return True
+
+        await self.send(writer, 404, b'404 page not found', content_type='text/plain')
+        return True
+
+    def authorized(self, headers):
+        cookies = dict(part.strip().split('=', 1) for part in headers.get('cookie', '').split(';') if '=' in part)
+        created = self.sessions.get(cookies.get('session'))
+        if created is None: return False
+        if self.options.auth_expiry and time.monotonic() - created > self.options.auth_expiry:
+            del self.sessions[cookies['session']]
+            return False
+        return True
+
+    async def send(self, writer, status, body, content_type='application/json', extra=None):
+        head = [f"HTTP/1.1 {status} {REASONS.get(status, 'OK')}", f"Content-Type: {content_type}", f"Content-Length: {len(body)}"]
+        head += [f"{key}: {value}" for key, value in (extra or {}).items()]
+        writer.write(("\r\n".join(head) + "\r\n\r\n").encode() + body)
+        await writer.drain()
+
+    async def send_database(self, writer, headers, head_only=False):
+        data = memoryview(self.database)
+        status, extra = 200, {}
+        ranged = headers.get('range', '')
+        if ranged.startswith('bytes='):
+            start, _, end = ranged[6:].partition('-')
+            start, end = int(start or 0), min(int(end) if end else len(data) - 1, len(data) - 1)
+            extra['Content-Range'] = f"bytes {start}-{end}/{len(data)}"
+            data, status = data[start:end + 1], 206
+        head = [f"HTTP/1.1 {status} {REASONS[status]}", "Content-Type: application/octet-stream", f"Content-Length: {len(data)}",
+                'Content-Disposition: attachment; filename="x-ui.db"'] + [f"{k}: {v}" for k, v in extra.items()]
+        writer.write(("\r\n".join(head) + "\r\n\r\n").encode())
+        if head_only: return await writer.drain()
+        for offset in range(0, len(data), CHUNK_SIZE):
+            writer.write(data[offset:offset + CHUNK_SIZE])
+            await writer.drain()
+
+
+async def serve(options):
+    database = build_database(options.db_size)
+    servers = []
+    for index in range(options.count):
+        panel = FakePanel(options, database)
+        servers.append(await asyncio.start_server(panel.handle, options.host, options.port + index, backlog=256))
+    print(f"READY {options.port} {options.count} {len(database)}", flush=True)
+    await asyncio.gather(*(server.serve_forever() for server in servers))
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Fake X-UI panel(s) for load testing")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=21000, help="first port")
+    parser.add_argument('--count', type=int, default=1, help="number of panels (consecutive ports)")
+    parser.add_argument('--latency', type=float, default=0, help="mean response delay in ms")
+    parser.add_argument('--jitter', type=float, default=0, help="standard deviation of the delay in ms")
+    parser.add_argument('--fail-rate', type=float, default=0, help="fraction of requests answered with 500 or a dropped connection")
+    parser.add_argument('--auth-expiry', type=float, default=0, help="seconds before a login session expires (0 = never)")
+    parser.add_argument('--expired-status', type=int, default=401, choices=(401, 404), help="status returned for an expired/missing session")
+    parser.add_argument('--db-size', type=parse_size, default=parse_size('1MB'), help="approximate database size, e.g. 512KB, 20MB")
+    parser.add_argument('--db-path', dest='db_paths', action='append', choices=DB_PATHS, help="serve the database only on this path (repeatable; default: all)")
+    parser.add_argument('--version', default='2.3.5', help="panel version advertised on the login page")
+    parser.add_argument('--username', default='admin')
+    parser.add_argument('--password', default='admin')
+    options = parser.parse_args(argv)
+    options.db_paths = options.db_paths or DB_PATHS
+    return options
+
+
+if __name__ == '__main__':
+    try: asyncio.run(serve(parse_args()))
+    except KeyboardInterrupt: sys.exit(0)
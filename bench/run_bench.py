@@ -0,0 +1,253 @@
+"""بنچمارک موتور مانیتورینگ و بکاپ در برابر پنل‌های ساختگی (bench/fake_panel.py)
+
+برای هر تعداد سرور یک Process پنل ساختگی و یک Process جدا برای اجرای main.py (با config و پوشه کاری موقت) ساخته می‌شود
+و برای هر مرحله زمان کل، بیشینه حافظه (RSS)، بیشینه سوکت‌های باز و بیشینه تعداد Threadها اندازه‌گیری می‌شود.
+
+python bench/run_bench.py --servers 10 100 500 --latency 50 --db-size 1MB --output bench_results.json
+python bench/run_bench.py --servers 100 --baseline bench_results.json --tolerance 0.25   # خروجی غیرصفر در صورت پسرفت
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_ROOT = os.path.dirname(BENCH_DIR)
+PHASES = ('monitor', 'monitor_warm', 'backup')
+COMPARED = ('seconds', 'peak_rss_mb')
+
+
+# --- اندازه‌گیری (داخل Process سناریو) ---
+def proc_status():
+    """(RSS به مگابایت, تعداد Threadها) از /proc؛ روی سیستم‌های دیگر فقط Threadهای پایتون"""
+    try:
+        with open('/proc/self/status') as f: fields = dict(line.split(':', 1) for line in f if ':' in line)
+        return int(fields['VmRSS'].split()[0]) / 1024, int(fields['Threads'])
+    except OSError:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, threading.active_count()
+
+
+def open_sockets():
+    try: fds = os.listdir('/proc/self/fd')
+    except OSError: return None
+    count = 0
+    for fd in fds:
+        try:
+            if os.readlink(f'/proc/self/fd/{fd}').startswith('socket:'): count += 1
+        except OSError: pass
+    return count
+
+
+class Sampler(threading.Thread):
+    """نمونه‌برداری دوره‌ای در Thread جدا تا مسدود شدن حلقه رویداد هم دیده شود (خود این Thread از شمارش کم می‌شود)"""
+
+    def __init__(self, interval=0.02):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.peak_rss = self.max_threads = 0
+        self.max_sockets = None
+
+    def sample(self):
+        rss, threads = proc_status()
+        sockets = open_sockets()
+        self.peak_rss = max(self.peak_rss, rss)
+        self.max_threads = max(self.max_threads, threads - 1)
+        if sockets is not None: self.max_sockets = max(self.max_sockets or 0, sockets)
+
+    def run(self):
+        while not self.stopped.wait(self.interval): self.sample()
+        self.sample()
+
+
+class FakeBot:
+    """جایگزین Bot تلگرام: فایل‌ها خوانده (و دور ریخته) می‌شوند، با تاخیر اختیاری برای شبیه‌سازی آپلود"""
+
+    def __init__(self, upload_latency=0.0):
+        self.upload_latency = upload_latency
+        self.documents = self.messages = self.bytes = 0
+        self.errors = []
+
+    async def send_document(self, chat_id, document, **kwargs):
+        for chunk in iter(lambda: document.read(64 * 1024), b''): self.bytes += len(chunk)
+        if self.upload_latency: await asyncio.sleep(self.upload_latency)
+        self.documents += 1
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.messages += 1
+        if text.startswith('❌'): self.errors.append(text.splitlines()[0])
+
+
+class FakeContext:
+    def __init__(self, bot): self.bot = bot
+
+
+async def measure(phase, servers, action):
+    sampler = Sampler()
+    sampler.start()
+    started = time.perf_counter()
+    try: details = await action()
+    finally:
+        elapsed = time.perf_counter() - started
+        sampler.stopped.set()
+        sampler.join()
+    return {'servers': servers, 'phase': phase, 'seconds': round(elapsed, 3), 'peak_rss_mb': round(sampler.peak_rss, 1),
+            'max_sockets': sampler.max_sockets, 'max_threads': sampler.max_threads, **details}
+
+
+async def run_phases(main, spec):
+    count = spec['servers']
+    results = []
+
+    async def monitor():
+        main.STATUS_SNAPSHOTS.clear()
+        await main.poll_all_status()
+        online = sum(1 for snap in main.STATUS_SNAPSHOTS.values() if snap['online'])
+        return {'ok': online, 'failed': count - online}
+
+    async def backup():
+        bot = FakeBot(spec['upload_latency'])
+        main.start_upload_worker(bot)
+        try:
+            started = time.perf_counter()
+            await main.run_backup_task(FakeContext(bot), chat_id=1, force=True)
+            downloaded = time.perf_counter() - started
+            while main.UPLOAD_QUEUE: await asyncio.sleep(0.05)
+        finally: await main.stop_upload_worker()
+        return {'ok': bot.documents, 'failed': count - bot.documents, 'download_seconds': round(downloaded, 3),
+                'uploaded_mb': round(bot.bytes / 2 ** 20, 1), 'errors': sorted(set(bot.errors))[:5]}
+
+    actions = {'monitor': monitor, 'monitor_warm': monitor, 'backup': backup}
+    for phase in spec['phases']: results.append(await measure(phase, count, actions[phase]))
+    await main.close_http_transport()
+    return results
+
+
+def run_scenario(spec):
+    """اجرای یک سناریو در Process فعلی؛ main.py در یک پوشه کاری موقت با config ساختگی import می‌شود"""
+    workdir = tempfile.mkdtemp(prefix='xui-bench-')
+    try:
+        from cryptography.fernet import Fernet
+        settings = {'BOT_TOKEN': '0:bench', 'ADMIN_ID': '1', 'ENCRYPTION_KEY': Fernet.generate_key().decode(),
+                    'TELEGRAM_CHAT_INTERVAL': 0, **spec['config']}
+        with open(os.path.join(workdir, 'config.py'), 'w') as f:
+            for key, value in settings.items(): f.write(f"{key} = {value!r}\n")
+        os.chdir(workdir)
+        sys.path[:0] = [workdir, REPO_ROOT]
+        import logging
+        import main
+        logging.getLogger().setLevel(logging.CRITICAL)
+        main.save_servers([{'id': f"bench{index:05d}", 'name': f"bench-{index}", 'url': f"http://127.0.0.1:{spec['port'] + index}",
+                            'username': 'admin', 'password': 'admin'} for index in range(spec['servers'])])
+        main.ensure_registry()
+        return asyncio.run(run_phases(main, spec))
+    finally:
+        os.chdir(REPO_ROOT)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+# --- هماهنگ‌کننده (Process اصلی) ---
+def start_panel(options, count):
+    command = [sys.executable, os.path.join(BENCH_DIR, 'fake_panel.py'), '--port', str(options.port), '--count', str(count),
+               '--latency', str(options.latency), '--jitter', str(options.jitter), '--fail-rate', str(options.fail_rate),
+               '--auth-expiry', str(options.auth_expiry), '--db-size', str(options.db_size)]
+    panel = subprocess.Popen(command, stdout=subprocess.PIPE, text=True)
+    line = panel.stdout.readline()
+    if not line.startswith('READY'):
+        panel.kill()
+        raise RuntimeError(f"fake panel failed to start: {line!r}")
+    return panel, int(line.split()[3])
+
+
+def run_benchmark(options):
+    results = []
+    for count in options.servers:
+        panel, db_bytes = start_panel(options, count)
+        try:
+            spec = {'servers': count, 'port': options.port, 'phases': options.phases, 'upload_latency': options.upload_latency,
+                    'config': dict(item.split('=', 1) for item in options.set)}
+            spec['config'] = {key: json.loads(value) for key, value in spec['config'].items()}
+            proc = subprocess.run([sys.executable, os.path.abspath(__file__), '--scenario', json.dumps(spec)],
+                                  capture_output=True, text=True, timeout=options.timeout)
+            if proc.returncode != 0:
+                print(proc.stderr, file=sys.stderr)
+                raise RuntimeError(f"scenario with {count} servers failed")
+            for row in json.loads(proc.stdout.strip().splitlines()[-1]):
+                row['db_bytes'] = db_bytes
+                results.append(row)
+                print(f"{count:>5} servers  {row['phase']:<13} {row['seconds']:>8.2f}s  rss {row['peak_rss_mb']:>7.1f} MB  "
+                      f"sockets {row['max_sockets']}  threads {row['max_threads']}  ok {row['ok']}/{count}", flush=True)
+        finally:
+            panel.terminate()
+            panel.wait()
+    return results
+
+
+def git_commit():
+    try: return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_ROOT, capture_output=True, text=True).stdout.strip() or None
+    except OSError: return None
+
+
+def compare(results, baseline_file, tolerance):
+    """ردیف‌هایی که نسبت به فایل پایه بیش از tolerance بدتر شده‌اند"""
+    with open(baseline_file) as f: baseline = {(row['servers'], row['phase']): row for row in json.load(f)['results']}
+    regressions = []
+    for row in results:
+        base = baseline.get((row['servers'], row['phase']))
+        if not base: continue
+        for key in COMPARED:
+            if base.get(key) and row[key] > base[key] * (1 + tolerance):
+                regressions.append(f"{row['servers']} servers / {row['phase']}: {key} {base[key]} -> {row[key]}")
+    return regressions
+
+
+def parse_args(argv=None):
+    sys.path.insert(0, BENCH_DIR)
+    from fake_panel import parse_size
+    parser = argparse.ArgumentParser(description="Benchmark the monitor and backup pipeline against fake X-UI panels")
+    parser.add_argument('--servers', type=int, nargs='+', default=[10, 100])
+    parser.add_argument('--phases', nargs='+', choices=PHASES, default=list(PHASES))
+    parser.add_argument('--port', type=int, default=21000)
+    parser.add_argument('--latency', type=float, default=20, help="fake panel mean delay in ms")
+    parser.add_argument('--jitter', type=float, default=5)
+    parser.add_argument('--fail-rate', type=float, default=0)
+    parser.add_argument('--auth-expiry', type=float, default=0)
+    parser.add_argument('--db-size', type=parse_size, default=parse_size('1MB'))
+    parser.add_argument('--upload-latency', type=float, default=0, help="simulated seconds per Telegram upload")
+    parser.add_argument('--set', action='append', default=[], metavar='KEY=JSON', help="extra config.py value, e.g. BACKUP_CONCURRENCY=20")
+    parser.add_argument('--timeout', type=int, default=1800, help="seconds allowed per server count")
+    parser.add_argument('--output', default='bench_results.json')
+    parser.add_argument('--baseline', help="previous results file to compare against")
+    parser.add_argument('--tolerance', type=float, default=0.25, help="allowed slowdown/growth before a regression is reported")
+    parser.add_argument('--scenario', help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+def main():
+    options = parse_args()
+    if options.scenario:
+        print(json.dumps(run_scenario(json.loads(options.scenario))))
+        return
+    results = run_benchmark(options)
+    report = {'generated_at': datetime.now().isoformat(timespec='seconds'), 'commit': git_commit(), 'python': platform.python_version(),
+              'platform': platform.platform(), 'cpus': os.cpu_count(),
+              'params': {k: v for k, v in vars(options).items() if k not in ('scenario', 'baseline', 'output')}, 'results': results}
+    with open(options.output, 'w') as f: json.dump(report, f, indent=2)
+    print(f"Results written to {options.output}")
+    if options.baseline:
+        regressions = compare(results, options.baseline, options.tolerance)
+        for line in regressions: print(f"REGRESSION {line}")
+        if regressions: sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
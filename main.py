@@ -1,43 +1,147 @@
 import logging
-import requests
+import multiprocessing
+import httpx
 import json
 import os
 import asyncio
+import hashlib
 import pytz
+import re
+import shutil
+import sqlite3
+import struct
+import sys
+import tempfile
 import time
-from datetime import datetime, time as dtime
+import types
+import uuid
+import zipfile
+import zlib
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from collections import OrderedDict, deque
+from urllib.parse import urlsplit
+from datetime import datetime, timedelta, time as dtime
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, ReplyKeyboardRemove, KeyboardButton
+from telegram.error import RetryAfter, BadRequest, NetworkError
+from telegram.helpers import escape_markdown
 from telegram.ext import (
     Application, CommandHandler, MessageHandler, CallbackQueryHandler, 
     filters, ContextTypes, ConversationHandler, Defaults
 )
-from requests.packages.urllib3.exceptions import InsecureRequestWarning
 from cryptography.fernet import Fernet
 
-requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
-
 # --- لود کانفیگ ---
+# ابزار restore آفلاین است: بدون config.py ربات هم اجرا می‌شود و چیزی در پوشه جاری نمی‌سازد
+OFFLINE_RESTORE = __name__ == '__main__' and sys.argv[1:2] == ['restore']
 try:
     import config
     if not hasattr(config, 'ENCRYPTION_KEY'):
         print("Warning: ENCRYPTION_KEY missing. Generating temporary key.")
         config.ENCRYPTION_KEY = Fernet.generate_key().decode()
 except ImportError:
-    print("Error: config.py not found.")
-    exit(1)
+    if not OFFLINE_RESTORE:
+        print("Error: config.py not found.")
+        exit(1)
+    config = types.SimpleNamespace(ENCRYPTION_KEY=Fernet.generate_key().decode())
 
 # --- تنظیمات ---
 DATA_FILE = "servers.json"
 SETTINGS_FILE = "settings.json"
+BACKUP_STATE_FILE = "backup_state.json"
+METRICS_FILE = "metrics.db"
 BACKUP_DIR = "backups"
-os.makedirs(BACKUP_DIR, exist_ok=True)
+BASELINE_DIR = os.path.join(BACKUP_DIR, "baselines")
+if not OFFLINE_RESTORE: os.makedirs(BACKUP_DIR, exist_ok=True)
 CIPHER_SUITE = Fernet(config.ENCRYPTION_KEY.encode())
 
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
 logger = logging.getLogger(__name__)
+logging.getLogger('httpx').setLevel(logging.WARNING)
 
+SQLITE_MAGIC = b'SQLite format 3'
+TIMEZONE = pytz.timezone('Asia/Tehran')
 POSSIBLE_PATHS = ["/panel/api/server/getDb", "/server/getDb", "/xui/server/getDb", "/api/server/getDb"]
 
+# --- تنظیمات موتور بکاپ موازی (قابل تغییر از config.py) ---
+BACKUP_CONCURRENCY = max(1, int(getattr(config, 'BACKUP_CONCURRENCY', 10)))
+# سقف «بدون پیشرفت»: بکاپ یک سرور فقط وقتی رها می‌شود که این مدت هیچ داده‌ای دریافت نشود (نه سقف زمان کل)
+BACKUP_SERVER_TIMEOUT = int(getattr(config, 'BACKUP_SERVER_TIMEOUT', 120))
+# شروع سرورهای واحد زمان‌بندی پیش‌فرض در این بازه (ثانیه، حداکثر نصف بازه بکاپ) پخش می‌شود؛ 0 = همه با هم
+BACKUP_STAGGER = max(0, int(getattr(config, 'BACKUP_STAGGER', 300)))
+
+# --- تنظیمات کلاینت HTTP ---
+HTTP_MAX_CONNECTIONS = int(getattr(config, 'HTTP_MAX_CONNECTIONS', 200))
+HTTP_PER_HOST_LIMIT = max(1, int(getattr(config, 'HTTP_PER_HOST_LIMIT', 4)))
+LATENCY_SAMPLES = 50
+LATENCY_FACTOR = float(getattr(config, 'LATENCY_FACTOR', 3.0))
+CIRCUIT_THRESHOLD = max(1, int(getattr(config, 'CIRCUIT_THRESHOLD', 3)))
+CIRCUIT_BASE_DELAY = int(getattr(config, 'CIRCUIT_BASE_DELAY', 60))
+CIRCUIT_MAX_DELAY = int(getattr(config, 'CIRCUIT_MAX_DELAY', 3600))
+MONITOR_INTERVAL = int(getattr(config, 'MONITOR_INTERVAL', 120))
+MONITOR_CONCURRENCY = max(1, int(getattr(config, 'MONITOR_CONCURRENCY', 20)))
+METRICS_RAW_HOURS = int(getattr(config, 'METRICS_RAW_HOURS', 48))
+METRICS_RETENTION_DAYS = int(getattr(config, 'METRICS_RETENTION_DAYS', 90))
+SESSION_TTL = int(getattr(config, 'SESSION_TTL', 1800))
+SESSION_CACHE_SIZE = max(1, int(getattr(config, 'SESSION_CACHE_SIZE', 500)))
+MAX_DB_SIZE = int(getattr(config, 'MAX_DB_SIZE', 512 * 1024 * 1024))
+
+# --- تنظیمات ارسال آرشیوی ---
+# سقف ارسال فایل توسط Bot API برابر 50MB است (با Bot API Server محلی بیشتر)؛ کمی فاصله برای اطمینان
+TELEGRAM_UPLOAD_LIMIT = int(getattr(config, 'TELEGRAM_UPLOAD_LIMIT', 50 * 1024 * 1024))
+ARCHIVE_PART_LIMIT = int(getattr(config, 'ARCHIVE_PART_LIMIT', 45 * 1024 * 1024))
+COMPRESS_WORKERS = max(1, int(getattr(config, 'COMPRESS_WORKERS', 2)))
+COMPRESS_LEVEL = 6
+# تعداد تکه‌های نمونه برای تخمین نسبت فشرده‌سازی هنگام گروه‌بندی آرشیوها
+COMPRESS_SAMPLES = 16
+COMPRESS_EXECUTOR = ThreadPoolExecutor(max_workers=COMPRESS_WORKERS, thread_name_prefix='compress')
+DELIVERY_LABELS = {'file': "📄 تکی", 'archive': "🗜 آرشیو فشرده"}
+
+# --- تنظیمات بکاپ افزایشی ---
+INCREMENTAL_FULL_EVERY = max(1, int(getattr(config, 'INCREMENTAL_FULL_EVERY', 24)))
+INCREMENTAL_MAX_RATIO = float(getattr(config, 'INCREMENTAL_MAX_RATIO', 0.5))
+BACKUP_MODE_LABELS = {'full': "📦 کامل", 'incremental': "🧩 افزایشی"}
+DELTA_MAGIC = b'XUIDELTA1'
+DELTA_HEADER = struct.Struct('>IQ32s32sI')
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+# --- تنظیمات بررسی سلامت دیتابیس ---
+VERIFY_WORKERS = max(1, int(getattr(config, 'VERIFY_WORKERS', 2)))
+# کاهش نسبی تعداد کاربران نسبت به بکاپ قبلی که باعث هشدار می‌شود (۰ = غیرفعال)
+CLIENT_DROP_ALERT = float(getattr(config, 'CLIENT_DROP_ALERT', 0.2))
+
+# --- تنظیمات ابزار اندازه‌گیری (Prometheus) ---
+# 0 = خاموش؛ در غیر این صورت /metrics روی METRICS_HOST:METRICS_PORT در دسترس است
+METRICS_PORT = int(getattr(config, 'METRICS_PORT', 0))
+METRICS_HOST = getattr(config, 'METRICS_HOST', '127.0.0.1')
+
+# --- تنظیمات مخزن محلی Snapshot ---
+# لایه‌ها: هر ساعت برای SNAPSHOT_HOURLY_HOURS ساعت، هر روز تا SNAPSHOT_DAILY_DAYS روز و بعد از آن هر هفته
+SNAPSHOT_STORE = bool(getattr(config, 'SNAPSHOT_STORE', False))
+SNAPSHOT_DIR = os.path.join(BACKUP_DIR, "snapshots")
+SNAPSHOT_HOURLY_HOURS = int(getattr(config, 'SNAPSHOT_HOURLY_HOURS', 24))
+SNAPSHOT_DAILY_DAYS = int(getattr(config, 'SNAPSHOT_DAILY_DAYS', 30))
+SNAPSHOT_MAX_BYTES = int(getattr(config, 'SNAPSHOT_MAX_BYTES', 5 * 1024 * 1024 * 1024))
+
+# --- تنظیمات صف ارسال تلگرام ---
+UPLOAD_QUEUE_FILE = "upload_queue.json"
+UPLOAD_DIR = os.path.join(BACKUP_DIR, "outbox")
+FAILED_UPLOAD_DIR = os.path.join(BACKUP_DIR, "failed")
+# Bot API حدود یک پیام در ثانیه برای هر چت و ۳۰ پیام در ثانیه برای کل ربات را مجاز می‌داند
+TELEGRAM_CHAT_INTERVAL = float(getattr(config, 'TELEGRAM_CHAT_INTERVAL', 1.0))
+TELEGRAM_GLOBAL_INTERVAL = 1 / 30
+UPLOAD_MAX_ATTEMPTS = max(1, int(getattr(config, 'UPLOAD_MAX_ATTEMPTS', 20)))
+UPLOAD_RETRY_BASE = 5
+UPLOAD_RETRY_MAX = int(getattr(config, 'UPLOAD_RETRY_MAX', 1800))
+UPLOAD_TIMEOUT = int(getattr(config, 'UPLOAD_TIMEOUT', 300))
+
+# پروفایل‌های زمانی: (connect, read) برای لاگین و درخواست‌ها + تاخیر تلاش‌های مجدد
+TIMEOUT_PROFILES = {
+    'test': {'delays': [0], 'login': (3, 4), 'request': (3, 5)},
+    'monitor': {'delays': [0], 'login': (2, 3), 'request': (2, 3)},
+    'backup': {'delays': [0, 2, 5], 'login': (5, 15), 'request': (5, 20)},
+}
+
 # --- استیت‌های Conversation ---
 NAME, URL, USERNAME, PASSWORD = range(4)
 EDIT_WAIT_USER, EDIT_WAIT_PASS = range(4, 6)
@@ -74,46 +178,382 @@ def load_servers():
             return servers
     except: return []
 
+_encrypted_passwords = {}
+
 def save_servers(servers):
-    import copy
-    servers_encrypted = copy.deepcopy(servers)
-    for s in servers_encrypted: s['password'] = encrypt_text(s['password'])
-    with open(DATA_FILE, 'w') as f: json.dump(servers_encrypted, f, indent=4)
+    """ذخیره اتمیک (فایل موقت + rename)؛ پسوردهای بدون تغییر دوباره رمزنگاری نمی‌شوند"""
+    servers_encrypted = []
+    for s in servers:
+        cached = _encrypted_passwords.get(s.get('id'))
+        if not cached or cached[0] != s['password']:
+            cached = (s['password'], encrypt_text(s['password']))
+            if s.get('id'): _encrypted_passwords[s['id']] = cached
+        servers_encrypted.append({**s, 'password': cached[1]})
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(DATA_FILE)), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as f: json.dump(servers_encrypted, f, indent=4)
+        os.replace(tmp_path, DATA_FILE)
+    except:
+        if os.path.exists(tmp_path): os.remove(tmp_path)
+        raise
+
+# --- رجیستری سرورها در حافظه ---
+# سرورها فقط یک بار از دیسک خوانده و رمزگشایی می‌شوند؛ تغییرات با تاخیر کوتاه و
+# به صورت یکجا روی دیسک نوشته می‌شوند (write-behind)
+SERVER_SAVE_DELAY = 1.0
+_servers = None
+_save_handle = None
+
+def new_server_id(): return uuid.uuid4().hex[:8]
+
+def ensure_registry():
+    global _servers
+    if _servers is not None: return
+    _servers = OrderedDict()
+    servers = load_servers()
+    missing_ids = False
+    for server in servers:
+        if not server.get('id'):
+            server['id'] = new_server_id()
+            missing_ids = True
+        _servers[server['id']] = server
+    if missing_ids:
+        migrate_backup_state(servers)
+        flush_servers()
+
+def all_servers():
+    ensure_registry()
+    return list(_servers.values())
+
+def get_server(server_id):
+    ensure_registry()
+    return _servers.get(server_id)
+
+def add_server(server):
+    ensure_registry()
+    server = {**server, 'id': new_server_id()}
+    _servers[server['id']] = server
+    schedule_save()
+    return server
+
+def update_server(server_id, **changes):
+    """دیکشنری جدید جایگزین می‌شود تا عملیات در حال اجرا با نسخه قبلی سازگار بمانند"""
+    ensure_registry()
+    if server_id not in _servers: return None
+    _servers[server_id] = {**_servers[server_id], **changes}
+    schedule_save()
+    return _servers[server_id]
+
+def remove_server(server_id):
+    ensure_registry()
+    removed = _servers.pop(server_id, None)
+    if removed: schedule_save()
+    return removed
+
+def schedule_save():
+    global _save_handle
+    try: loop = asyncio.get_running_loop()
+    except RuntimeError:
+        flush_servers()
+        return
+    if _save_handle is None: _save_handle = loop.call_later(SERVER_SAVE_DELAY, flush_servers)
+
+def flush_servers():
+    global _save_handle
+    if _save_handle is not None:
+        _save_handle.cancel()
+        _save_handle = None
+    if _servers is None: return
+    try: save_servers(list(_servers.values()))
+    except Exception as e: logger.error(f"Saving servers failed: {e}")
 
 # --- مدیریت تنظیمات ---
 def load_settings():
-    default_settings = {"interval": 86400, "label": "هر 24 ساعت"}
+    default_settings = {"interval": 86400, "label": "هر 24 ساعت", "delivery": "file", "backup_mode": "full"}
     if not os.path.exists(SETTINGS_FILE): return default_settings
     try:
-        with open(SETTINGS_FILE, 'r') as f: return json.load(f)
+        with open(SETTINGS_FILE, 'r') as f: return {**default_settings, **json.load(f)}
     except: return default_settings
 
-def save_settings(interval, label):
+def save_settings(**changes):
+    settings = load_settings()
+    settings.update(changes)
     with open(SETTINGS_FILE, 'w') as f:
-        json.dump({"interval": interval, "label": label}, f)
+        json.dump(settings, f)
+
+def format_size(num_bytes):
+    size = float(num_bytes)
+    for unit in ('B', 'KB', 'MB'):
+        if size < 1024: return f"{size:.0f} {unit}" if unit == 'B' else f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} GB"
+
+# --- وضعیت آخرین بکاپ آپلودشده هر سرور (برای حذف بکاپ‌های تکراری) ---
+def server_key(server): return server.get('id') or server['url'].rstrip('/')
+
+def load_backup_state():
+    if not os.path.exists(BACKUP_STATE_FILE): return {}
+    try:
+        with open(BACKUP_STATE_FILE, 'r') as f: return json.load(f)
+    except: return {}
+
+def save_backup_state(state):
+    with open(BACKUP_STATE_FILE, 'w') as f: json.dump(state, f, indent=4)
+
+def migrate_backup_state(servers):
+    """انتقال وضعیت و Baseline ذخیره‌شده با کلید URL به شناسه ثابت سرور"""
+    state = load_backup_state()
+    for server in servers:
+        old_key = server['url'].rstrip('/')
+        if old_key in state and server['id'] not in state: state[server['id']] = state.pop(old_key)
+        old_base = baseline_path({**server, 'id': None})
+        if os.path.exists(old_base): os.replace(old_base, baseline_path(server))
+    if state: save_backup_state(state)
+
+def file_digest(filepath):
+    h = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b''): h.update(chunk)
+    return h.hexdigest()
 
 def check_auth(user_id): return user_id == int(config.ADMIN_ID)
 
+# --- کلاینت HTTP مشترک ---
+_http_transport = None
+_host_slots = {}
+
+def get_http_transport():
+    """ترنسپورت مشترک (Connection Pool) برای همه پنل‌ها؛ TLS بررسی نمی‌شود"""
+    global _http_transport
+    if _http_transport is None:
+        limits = httpx.Limits(max_connections=HTTP_MAX_CONNECTIONS, max_keepalive_connections=HTTP_MAX_CONNECTIONS)
+        _http_transport = httpx.AsyncHTTPTransport(verify=False, limits=limits, retries=0)
+    return _http_transport
+
+def new_panel_client():
+    # هر سرور کوکی‌های خودش را دارد ولی اتصال‌ها از Pool مشترک می‌آیند
+    return httpx.AsyncClient(transport=get_http_transport(), verify=False, follow_redirects=True)
+
+def host_slot(url):
+    """محدودیت تعداد اتصال هم‌زمان به هر هاست"""
+    host = urlsplit(url).netloc
+    if host not in _host_slots: _host_slots[host] = asyncio.Semaphore(HTTP_PER_HOST_LIMIT)
+    return _host_slots[host]
+
+def make_timeout(pair):
+    connect, read = pair
+    return httpx.Timeout(read, connect=connect, pool=None)
+
+async def close_http_transport():
+    global _http_transport
+    if _http_transport is not None:
+        await _http_transport.aclose()
+        _http_transport = None
+
+# --- تایم‌اوت تطبیقی و Circuit Breaker هر سرور ---
+# زمان پاسخ لاگین/وضعیت هر سرور نگه داشته می‌شود و تایم‌اوت از صدک 95 آن به دست می‌آید
+# (پروفایل‌های ثابت سقف تایم‌اوت هستند). بعد از CIRCUIT_THRESHOLD خطای پیاپی سرور با
+# فاصله نمایی کنار گذاشته می‌شود و بعد از آن فقط یک درخواست آزمایشی (half-open) مجاز است.
+_latencies = {}
+_circuits = {}
+
+def record_latency(server, seconds):
+    _latencies.setdefault(server_key(server), deque(maxlen=LATENCY_SAMPLES)).append(seconds)
+
+def latency_percentile(server, pct=95):
+    samples = sorted(_latencies.get(server_key(server), ()))
+    if len(samples) < 5: return None
+    return samples[min(len(samples) - 1, int(len(samples) * pct / 100))]
+
+def adaptive_timeout(server, mode, kind):
+    """تایم‌اوت پروفایل، کوتاه‌شده بر اساس سرعت واقعی سرور.
+    زمان خواندن دانلود دیتابیس تطبیقی نیست چون ساخت فایل روی پنل ربطی به سرعت لاگین ندارد."""
+    connect, read = TIMEOUT_PROFILES.get(mode, TIMEOUT_PROFILES['backup'])[kind]
+    p95 = latency_percentile(server)
+    if p95 is not None:
+        derived = p95 * LATENCY_FACTOR + 0.5
+        connect = min(connect, max(1.0, derived))
+        if not (mode == 'backup' and kind == 'request'): read = min(read, max(2.0, derived))
+    return make_timeout((connect, read))
+
+def circuit_state(server):
+    entry = _circuits.get(server_key(server))
+    if not entry or entry['failures'] < CIRCUIT_THRESHOLD: return 'closed'
+    if time.time() < entry['open_until'] or entry.get('probing'): return 'open'
+    return 'half_open'
+
+def circuit_allows(server):
+    state = circuit_state(server)
+    if state == 'half_open': _circuits[server_key(server)]['probing'] = True
+    return state != 'open'
+
+def record_result(server, ok):
+    key = server_key(server)
+    if ok:
+        _circuits.pop(key, None)
+        return
+    entry = _circuits.setdefault(key, {'failures': 0, 'opens': 0, 'open_until': 0})
+    entry['failures'] += 1
+    entry['probing'] = False
+    if entry['failures'] >= CIRCUIT_THRESHOLD:
+        entry['opens'] += 1
+        entry['open_until'] = time.time() + min(CIRCUIT_BASE_DELAY * 2 ** (entry['opens'] - 1), CIRCUIT_MAX_DELAY)
+        if entry['opens'] == 1: logger.warning(f"Circuit opened for {server['name']}")
+
+def open_circuits():
+    """[(server, ثانیه تا بررسی بعدی)] برای سرورهایی که مدارشان باز است"""
+    now = time.time()
+    result = []
+    for server in all_servers():
+        entry = _circuits.get(server_key(server))
+        if entry and entry['failures'] >= CIRCUIT_THRESHOLD: result.append((server, max(0, entry['open_until'] - now)))
+    return result
+
+# --- ابزار اندازه‌گیری (Instrumentation) ---
+# زمان، تعداد موفق/ناموفق و حجم هر مرحله برای هر سرور از زمان شروع ربات جمع می‌شود.
+# مراحل بکاپ سرورهایی که در حال بکاپ هستند جداگانه برای گزارش «آخرین اجرا» (/stats) هم ثبت می‌شوند.
+STAGE_LABELS = {'login': "لاگین", 'discover': "کشف مسیر", 'download': "دانلود", 'disk_write': "نوشتن روی دیسک", 'verify': "بررسی سلامت",
+                'queue_wait': "انتظار در صف", 'upload': "آپلود تلگرام", 'monitor_login': "لاگین مانیتور", 'status': "وضعیت"}
+RUN_STAGES = ('login', 'discover', 'download', 'disk_write', 'verify', 'queue_wait', 'upload')
+STAGE_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+_stage_totals = {}  # (stage, server_id) -> [ok, failed, seconds, bytes]
+_stage_histograms = {}  # stage -> [شمارش هر bucket..., کل, مجموع زمان]
+_run_stages = {}  # server_id -> {stage: seconds} برای آخرین اجرای بکاپ هر سرور
+LAST_RUN = {}
+
+def observe(stage, server_id, seconds, ok=True, nbytes=0):
+    totals = _stage_totals.setdefault((stage, server_id), [0, 0, 0.0, 0])
+    totals[0 if ok else 1] += 1
+    totals[2] += seconds
+    totals[3] += nbytes
+    histogram = _stage_histograms.setdefault(stage, [0] * (len(STAGE_BUCKETS) + 2))
+    for index, bound in enumerate(STAGE_BUCKETS):
+        if seconds <= bound: histogram[index] += 1
+    histogram[-2] += 1
+    histogram[-1] += seconds
+    if stage in RUN_STAGES and server_id in _run_stages:
+        _run_stages[server_id][stage] = _run_stages[server_id].get(stage, 0) + seconds
+
+def begin_run_stages(server_ids):
+    for server_id in server_ids: _run_stages[server_id] = {}
+
+def finish_run_stages(server_ids, started, seconds):
+    """ثبت اجرای تمام‌شده به‌عنوان آخرین اجرا؛ زمان آپلود و انتظار در صف بعداً (وقتی صف ارسال کرد) به همین رکورد اضافه می‌شود"""
+    LAST_RUN.clear()
+    LAST_RUN.update({'started': started, 'seconds': seconds, 'servers': {sid: _run_stages[sid] for sid in server_ids if sid in _run_stages}})
+
+def prometheus_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def render_prometheus():
+    lines = []
+    def metric(name, kind, help_text, samples):
+        lines.extend([f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"])
+        for labels, value in samples:
+            label_text = ",".join(f'{k}="{prometheus_label(v)}"' for k, v in labels.items())
+            lines.append(f"{name}{{{label_text}}} {value}" if label_text else f"{name} {value}")
+    totals = sorted(_stage_totals.items())
+    metric('xui_stage_seconds_total', 'counter', "Time spent per stage and server.",
+           [({'stage': stage, 'server': sid}, round(t[2], 6)) for (stage, sid), t in totals])
+    metric('xui_stage_total', 'counter', "Stage executions per server and result.",
+           [({'stage': stage, 'server': sid, 'result': result}, t[i]) for (stage, sid), t in totals for i, result in ((0, 'ok'), (1, 'failed'))])
+    metric('xui_stage_bytes_total', 'counter', "Bytes moved per stage and server.",
+           [({'stage': stage, 'server': sid}, t[3]) for (stage, sid), t in totals if t[3]])
+    lines.extend(["# HELP xui_stage_duration_seconds Stage duration distribution.", "# TYPE xui_stage_duration_seconds histogram"])
+    for stage, histogram in sorted(_stage_histograms.items()):
+        for bound, count in zip(STAGE_BUCKETS, histogram):
+            lines.append(f'xui_stage_duration_seconds_bucket{{stage="{stage}",le="{bound}"}} {count}')
+        lines.append(f'xui_stage_duration_seconds_bucket{{stage="{stage}",le="+Inf"}} {histogram[-2]}')
+        lines.append(f'xui_stage_duration_seconds_count{{stage="{stage}"}} {histogram[-2]}')
+        lines.append(f'xui_stage_duration_seconds_sum{{stage="{stage}"}} {round(histogram[-1], 6)}')
+    servers = all_servers()
+    metric('xui_server_info', 'gauge', "Registered servers (id to name).", [({'server': s['id'], 'name': s['name']}, 1) for s in servers])
+    metric('xui_servers', 'gauge', "Number of registered servers.", [({}, len(servers))])
+    metric('xui_open_circuits', 'gauge', "Servers currently skipped by the circuit breaker.", [({}, len(open_circuits()))])
+    metric('xui_backup_running', 'gauge', "Servers with a backup in progress.", [({}, len(BACKUP_RUNNING))])
+    stats = upload_queue_stats()
+    metric('xui_upload_queue_depth', 'gauge', "Files waiting in the Telegram upload queue.", [({}, stats['depth'])])
+    metric('xui_upload_queue_bytes', 'gauge', "Bytes waiting in the Telegram upload queue.", [({}, stats['bytes'])])
+    if LAST_RUN:
+        metric('xui_last_backup_run_seconds', 'gauge', "Duration of the last backup run.", [({}, round(LAST_RUN['seconds'], 3))])
+        metric('xui_last_backup_run_timestamp_seconds', 'gauge', "Start time of the last backup run.", [({}, round(LAST_RUN['started'], 3))])
+    return "\n".join(lines) + "\n"
+
+_metrics_server = None
+
+async def handle_metrics_request(reader, writer):
+    try:
+        request = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), timeout=10)
+        parts = request.split(b' ', 2)
+        if len(parts) > 1 and parts[0] == b'GET' and parts[1].split(b'?')[0] == b'/metrics':
+            status, body, ctype = "200 OK", render_prometheus().encode(), "text/plain; version=0.0.4; charset=utf-8"
+        else:
+            status, body, ctype = "404 Not Found", b"not found\n", "text/plain"
+        writer.write(f"HTTP/1.1 {status}\r\nContent-Type: {ctype}\r\nContent-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body)
+        await writer.drain()
+    except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError): pass
+    except Exception as e: logger.error(f"Metrics endpoint error: {e}")
+    finally: writer.close()
+
+async def start_metrics_server():
+    global _metrics_server
+    if not METRICS_PORT: return
+    try:
+        _metrics_server = await asyncio.start_server(handle_metrics_request, METRICS_HOST, METRICS_PORT)
+        logger.info(f"Prometheus metrics on http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+    except OSError as e: logger.error(f"Metrics endpoint could not start: {e}")
+
+async def stop_metrics_server():
+    if _metrics_server:
+        _metrics_server.close()
+        await _metrics_server.wait_closed()
+
+async def stats_command(update, context):
+    """/stats — کندترین سرورها و مراحل در آخرین اجرای بکاپ"""
+    if not check_auth(update.effective_user.id): return
+    if not LAST_RUN or not LAST_RUN['servers']:
+        await update.message.reply_text("📭 هنوز اجرای بکاپی ثبت نشده است.")
+        return
+    runs = LAST_RUN['servers']
+    started = datetime.fromtimestamp(LAST_RUN['started']).strftime('%Y-%m-%d %H:%M:%S')
+    lines = [f"📊 **آخرین اجرای بکاپ:** {started}", f"🗂 {len(runs)} سرور در {LAST_RUN['seconds']:.1f} ثانیه", "", "⏱ **مراحل (مجموع / کندترین سرور):**"]
+    for stage in RUN_STAGES:
+        values = [(stages[stage], sid) for sid, stages in runs.items() if stage in stages]
+        if not values: continue
+        slowest, sid = max(values)
+        server = get_server(sid)
+        lines.append(f"• {STAGE_LABELS[stage]}: {sum(v for v, _ in values):.1f}s / {slowest:.1f}s ({escape_markdown(server['name'] if server else sid)})")
+    lines += ["", "🐢 **کندترین سرورها:**"]
+    ranked = sorted(runs.items(), key=lambda item: sum(item[1].values()), reverse=True)[:5]
+    for sid, stages in ranked:
+        server = get_server(sid)
+        top = sorted(stages.items(), key=lambda item: item[1], reverse=True)[:3]
+        detail = "، ".join(f"{STAGE_LABELS[k]} {v:.1f}s" for k, v in top)
+        lines.append(f"• {escape_markdown(server['name'] if server else sid)}: {sum(stages.values()):.1f}s ({detail or '-'})")
+    failed = sum(t[1] for (stage, _), t in _stage_totals.items() if stage in RUN_STAGES)
+    moved = sum(t[3] for (stage, _), t in _stage_totals.items() if stage in ('download', 'upload'))
+    lines += ["", f"📈 از شروع ربات: {format_size(moved)} جابه‌جا شده، {failed} مرحله ناموفق"]
+    await update.message.reply_text("\n".join(lines), parse_mode='Markdown')
+
 # --- توابع لاگین و بکاپ (V18 Logic) ---
-def get_authenticated_session(server, mode='backup'):
-    session = requests.Session()
+async def get_authenticated_session(server, mode='backup'):
+    client = new_panel_client()
     base_url = server['url'].rstrip('/')
     login_url = f"{base_url}/login"
-    
-    if mode == 'test':
-        delays = [0]
-        timeout = (3, 4) 
-    elif mode == 'monitor':
-        delays = [0]
-        timeout = (2, 3)
-    else: # backup
-        delays = [0, 2, 5]
-        timeout = (5, 15)
+    profile = TIMEOUT_PROFILES.get(mode, TIMEOUT_PROFILES['backup'])
+    # سروری که اخیراً خطا داده دوباره سه بار تلاش نمی‌شود
+    delays = profile['delays'] if server_key(server) not in _circuits else [0]
+    timeout = adaptive_timeout(server, mode, 'login')
+    stage = 'login' if mode == 'backup' else 'monitor_login'
+    first_started = time.monotonic()
 
     for attempt, delay in enumerate(delays, 1):
-        if delay > 0: time.sleep(delay)
+        if delay > 0: await asyncio.sleep(delay)
         try:
-            res = session.post(login_url, data={'username': server['username'], 'password': server['password']}, verify=False, timeout=timeout)
+            started = time.monotonic()
+            async with host_slot(base_url):
+                res = await client.post(login_url, data={'username': server['username'], 'password': server['password']}, timeout=timeout)
+            record_latency(server, time.monotonic() - started)
             
             is_logged_in = False
             try:
@@ -124,81 +564,720 @@ def get_authenticated_session(server, mode='backup'):
                     is_logged_in = True
             
             if is_logged_in:
-                return session, base_url, None
+                observe(stage, server_key(server), time.monotonic() - first_started)
+                return client, base_url, None
         except Exception as e:
-            if attempt == len(delays): return None, None, str(e)
+            if attempt == len(delays):
+                observe(stage, server_key(server), time.monotonic() - first_started, ok=False)
+                return None, None, str(e) or type(e).__name__
             
+    observe(stage, server_key(server), time.monotonic() - first_started, ok=False)
     return None, None, "Login Failed"
 
-def perform_backup_sync(server, mode='backup'):
-    session, base_url, error = get_authenticated_session(server, mode=mode)
-    if not session: return None, error
-    
-    saved_path = server.get('db_path')
-    paths_to_scan = []
-    if saved_path: paths_to_scan.append(saved_path)
-    for p in POSSIBLE_PATHS:
-        if p != saved_path: paths_to_scan.append(p)
-    
-    if mode == 'test': req_timeout = (3, 5)
-    elif mode == 'monitor': req_timeout = (2, 3)
-    else: req_timeout = (5, 20)
+# --- کش سشن‌های لاگین‌شده ---
+# کلاینت‌های حذف‌شده بسته نمی‌شوند چون aclose ترنسپورت مشترک را هم می‌بندد
+_session_cache = OrderedDict()
+_session_locks = {}
+
+def session_key(server): return (server['url'].rstrip('/'), server['username'], server['password'])
 
-    for path in paths_to_scan:
-        if not path: continue
+def invalidate_session(server):
+    _session_cache.pop(session_key(server), None)
+
+def prune_session_cache():
+    now = time.monotonic()
+    for key in [k for k, (_, _, created) in _session_cache.items() if now - created > SESSION_TTL]:
+        del _session_cache[key]
+    while len(_session_cache) > SESSION_CACHE_SIZE:
+        _session_cache.popitem(last=False)
+
+async def get_panel_session(server, mode='backup', fresh=False):
+    """سشن کش‌شده را برمی‌گرداند و فقط در صورت نبود/انقضا دوباره لاگین می‌کند.
+    خروجی: (client, base_url, reused, error)"""
+    key = session_key(server)
+    if fresh: _session_cache.pop(key, None)
+    lock = _session_locks.setdefault(key, asyncio.Lock())
+    async with lock:
+        prune_session_cache()
+        cached = _session_cache.get(key)
+        if cached:
+            _session_cache.move_to_end(key)
+            return cached[0], cached[1], True, None
+        client, base_url, error = await get_authenticated_session(server, mode=mode)
+        if not client:
+            _session_locks.pop(key, None)
+            return None, None, False, error
+        _session_cache[key] = (client, base_url, time.monotonic())
+        prune_session_cache()
+        return client, base_url, False, None
+
+def is_session_expired(res):
+    """401، ریدایرکت به صفحه لاگین یا پاسخ HTML به جای داده = سشن منقضی شده"""
+    if res.status_code == 401: return True
+    if res.history and 'login' in res.url.path: return True
+    return 'text/html' in res.headers.get('content-type', '')
+
+def backup_file_name(server):
+    safe_name = "".join([c for c in server['name'] if c.isalpha() or c.isdigit() or c in (' ', '-', '_')]).strip()
+    if not safe_name: safe_name = "server"
+    return f"{safe_name}.db"
+
+def backup_file_path(server):
+    # مسیر روی دیسک برای هر سرور یکتاست تا بکاپ‌های موازی سرورهای هم‌نام روی هم نوشته نشوند
+    suffix = hashlib.sha1(server_key(server).encode()).hexdigest()[:8]
+    return os.path.join(BACKUP_DIR, f"{backup_file_name(server)[:-3]}_{suffix}.db")
+
+class DownloadTooLarge(Exception): pass
+
+async def stream_db_to_file(client, url, filepath, timeout, stats=None):
+    """دانلود تکه‌تکه دیتابیس روی دیسک؛ هدر SQLite از اولین تکه بررسی می‌شود و
+    فایل فقط بعد از اتمام کامل دانلود (با rename اتمیک) جایگزین می‌شود.
+    stats (اختیاری): حجم دریافتی، زمان آخرین تکه دریافتی و زمان صرف‌شده برای نوشتن روی دیسک در آن ثبت می‌شود.
+    خروجی: (True, res) در صورت موفقیت یا (False, res) اگر پاسخ دیتابیس نبود"""
+    if stats is None: stats = {}
+    stats.setdefault('write', 0.0)
+    async with client.stream('GET', url, timeout=timeout) as res:
+        if res.status_code != 200: return False, res
+        declared = int(res.headers.get('content-length') or 0)
+        if declared > MAX_DB_SIZE: raise DownloadTooLarge(f"Database too large ({format_size(declared)})")
+
+        head, size, tmp_path, f = b'', 0, None, None
         try:
-            db_res = session.get(f"{base_url}{path}", verify=False, timeout=req_timeout)
-            
-            if db_res.status_code == 200 and db_res.content.startswith(b'SQLite format 3'):
-                safe_name = "".join([c for c in server['name'] if c.isalpha() or c.isdigit() or c in (' ', '-', '_')]).strip()
-                if not safe_name: safe_name = "server"
-                filename = f"{safe_name}.db"
-                filepath = os.path.join(BACKUP_DIR, filename)
-                with open(filepath, 'wb') as f: f.write(db_res.content)
-                return filepath, path
-        except: continue
-    return None, "Path not found or Auth Failed"
+            async for chunk in res.aiter_bytes(DOWNLOAD_CHUNK_SIZE):
+                if f is None:
+                    head += chunk
+                    if len(head) < len(SQLITE_MAGIC): continue
+                    if not head.startswith(SQLITE_MAGIC): return False, res
+                    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(filepath) or '.', suffix='.part')
+                    f = os.fdopen(fd, 'wb')
+                    chunk, head = head, b''
+                size += len(chunk)
+                stats['bytes'] = size
+                stats['active'] = time.monotonic()
+                if size > MAX_DB_SIZE: raise DownloadTooLarge(f"Database larger than {format_size(MAX_DB_SIZE)}")
+                write_started = time.monotonic()
+                f.write(chunk)
+                stats['write'] += time.monotonic() - write_started
+            if f is None: return False, res
+            write_started = time.monotonic()
+            f.close()
+            os.replace(tmp_path, filepath)
+            stats['write'] += time.monotonic() - write_started
+            tmp_path = None
+            return True, res
+        finally:
+            if f is not None and not f.closed: f.close()
+            if tmp_path and os.path.exists(tmp_path): os.remove(tmp_path)
+
+# --- کشف مسیر دیتابیس ---
+PANEL_VERSION_RE = re.compile(r'\.(?:js|css)\?v?=?(\d+(?:\.\d+){1,3})')
 
-def get_server_status_sync(server):
-    session, base_url, error = get_authenticated_session(server, mode='monitor')
-    if not session: return f"🔴 **{server['name']}**\n⚠️ Offline: {error}"
+async def detect_panel_version(client, base_url, timeout):
+    """شناسایی فورک/نسخه پنل از روی صفحه لاگین (نسخه در آدرس فایل‌های استاتیک آمده است)"""
     try:
-        status_res = session.post(f"{base_url}/server/status", verify=False, timeout=(2, 3))
-        if status_res.status_code == 200:
-            data = status_res.json()
-            if 'obj' in data: data = data['obj']
-            cpu = data.get('cpu', 0)
-            mem = data.get('mem', {})
-            mem_percent = round((mem.get('current', 0) / mem.get('total', 1)) * 100, 1)
-            uptime = data.get('uptime', 0)
-            status_emoji = "🟢" if cpu < 80 else "🔴"
-            return f"{status_emoji} **{server['name']}**\n💻 CPU: {cpu}% | RAM: {mem_percent}%\n⏳ Uptime: {uptime//86400}d\n🌐 `{server['url']}`"
-    except: pass
-    return f"🟢 **{server['name']}**\n(Login OK)\n🌐 `{server['url']}`"
-
-async def perform_backup_async(server, mode='backup'):
-    loop = asyncio.get_running_loop()
-    return await loop.run_in_executor(None, perform_backup_sync, server, mode)
+        async with host_slot(base_url):
+            res = await client.get(f"{base_url}/", timeout=timeout)
+        text = res.text
+    except Exception: return None
+    match = PANEL_VERSION_RE.search(text)
+    if not match: return None
+    lowered = text.lower()
+    fork = "3x-ui" if ("3x-ui" in lowered or "sanaei" in lowered) else "alireza" if "alireza" in lowered else "x-ui"
+    return f"{fork} {match.group(1)}"
+
+def remember_version_path(panel_version, path):
+    if not panel_version: return
+    known = load_settings().get('path_by_version', {})
+    if known.get(panel_version) != path:
+        known[panel_version] = path
+        save_settings(path_by_version=known)
+
+async def probe_db_path(client, base_url, path, timeout):
+    """درخواست سبک (Range) و بررسی فقط چند بایت اول؛ در صورت موفقیت مسیر را برمی‌گرداند"""
+    try:
+        async with host_slot(base_url):
+            async with client.stream('GET', f"{base_url}{path}", headers={'Range': f"bytes=0-{len(SQLITE_MAGIC)}"}, timeout=timeout) as res:
+                if res.status_code not in (200, 206): return None
+                head = b''
+                async for chunk in res.aiter_bytes():
+                    head += chunk
+                    if len(head) >= len(SQLITE_MAGIC): break
+                return path if head.startswith(SQLITE_MAGIC) else None
+    except Exception: return None
+
+async def discover_db_path(client, base_url, candidates, timeout):
+    """بررسی هم‌زمان همه مسیرها؛ اولین مسیر سالم برنده است و بقیه درخواست‌ها لغو می‌شوند"""
+    tasks = [asyncio.create_task(probe_db_path(client, base_url, path, timeout)) for path in candidates]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            path = await next_done
+            if path: return path
+        return None
+    finally:
+        for task in tasks: task.cancel()
+
+async def perform_backup_async(server, mode='backup', info=None):
+    """info (اختیاری): زمان لاگین و دانلود (ثانیه)، نسخه شناسایی‌شده پنل و پیشرفت دانلود جاری (transfer) در این دیکشنری ثبت می‌شود"""
+    if info is None: info = {}
+    req_timeout = adaptive_timeout(server, mode, 'request')
+    filepath = backup_file_path(server)
+
+    for fresh in (False, True):
+        started = time.monotonic()
+        client, base_url, reused, error = await get_panel_session(server, mode=mode, fresh=fresh)
+        if not client: return None, error
+        if not reused: info['login'] = time.monotonic() - started
+
+        async def download(path):
+            started = time.monotonic()
+            stats = info['transfer'] = {'active': started}
+            try:
+                async with host_slot(base_url):
+                    ok, db_res = await stream_db_to_file(client, f"{base_url}{path}", filepath, req_timeout, stats)
+            except DownloadTooLarge: raise
+            except Exception: ok, db_res = False, None
+            elapsed = time.monotonic() - started
+            observe('download', server_key(server), elapsed, ok=ok, nbytes=stats.get('bytes', 0) if ok else 0)
+            if stats.get('write'): observe('disk_write', server_key(server), stats['write'], ok=ok)
+            if ok: info['download'] = elapsed
+            return ok, db_res
+
+        try:
+            # 1) مسیر ذخیره‌شده همین سرور
+            tried = []
+            saved_path = server.get('db_path')
+            if saved_path:
+                tried.append(saved_path)
+                ok, db_res = await download(saved_path)
+                if ok: return filepath, saved_path
+                if reused and db_res is not None and (is_session_expired(db_res) or db_res.status_code == 200):
+                    logger.info(f"Session expired for {server['name']}, logging in again.")
+                    continue
+
+            # 2) مسیری که قبلاً برای همین نسخه پنل روی سرورهای دیگر کار کرده
+            # از کار افتادن مسیر ذخیره‌شده معمولاً یعنی پنل آپدیت شده؛ پس نسخه ذخیره‌شده دیگر قابل اعتماد نیست
+            if saved_path:
+                panel_version = await detect_panel_version(client, base_url, req_timeout)
+                info['panel_version'] = panel_version
+            else:
+                panel_version = server.get('panel_version') or await detect_panel_version(client, base_url, req_timeout)
+                if panel_version: info['panel_version'] = panel_version
+            known = load_settings().get('path_by_version', {}).get(panel_version)
+            if known and known not in tried:
+                tried.append(known)
+                ok, _ = await download(known)
+                if ok: return filepath, known
+
+            # 3) بررسی هم‌زمان بقیه مسیرها با درخواست‌های سبک
+            candidates = [p for p in POSSIBLE_PATHS if p not in tried]
+            discover_started = time.monotonic()
+            winner = await discover_db_path(client, base_url, candidates, req_timeout) if candidates else None
+            if candidates: observe('discover', server_key(server), time.monotonic() - discover_started, ok=bool(winner))
+            if winner:
+                ok, _ = await download(winner)
+                if ok:
+                    remember_version_path(panel_version, winner)
+                    return filepath, winner
+        except DownloadTooLarge as e: return None, str(e)
+        # بعضی پنل‌ها برای سشن منقضی 404 برمی‌گردانند؛ پس سشن قدیمی همیشه یک بار با لاگین تازه جبران می‌شود
+        if not reused: break
+    return None, "Path not found or Auth Failed"
+
+async def revalidate_version_path(panel_version, path, exclude_id=None):
+    """بعد از پیدا شدن مسیر جدید برای یک نسخه، همه سرورهای هم‌نسخه (یا با نسخه نامشخص) گروهی بررسی می‌شوند.
+    خروجی: تعداد سرورهایی که مسیرشان به‌روز شد"""
+    timeout = make_timeout(TIMEOUT_PROFILES['test']['request'])
+    targets = [s for s in all_servers() if s['id'] != exclude_id and s.get('db_path') != path and s.get('panel_version') in (panel_version, None)]
+    semaphore = asyncio.Semaphore(MONITOR_CONCURRENCY)
+
+    async def check(server):
+        async with semaphore:
+            client, base_url, _, error = await get_panel_session(server, mode='test')
+            if not client: return False
+            version = await detect_panel_version(client, base_url, timeout) or server.get('panel_version')
+            if version != panel_version:
+                if version: update_server(server['id'], panel_version=version)
+                return False
+            if not await probe_db_path(client, base_url, path, timeout): return False
+            update_server(server['id'], db_path=path, panel_version=version)
+            return True
+
+    results = await asyncio.gather(*[check(s) for s in targets])
+    return sum(1 for r in results if r)
 
 async def get_status_async(server):
+    """وضعیت لحظه‌ای پنل به صورت دیکشنری (snapshot)"""
+    started = time.monotonic()
+    snapshot = {'online': False, 'cpu': None, 'mem': None, 'uptime': None, 'latency': None, 'error': None}
+    for fresh in (False, True):
+        client, base_url, reused, error = await get_panel_session(server, mode='monitor', fresh=fresh)
+        if not client:
+            snapshot['error'] = error
+            break
+        snapshot['online'] = True
+        try:
+            request_started = time.monotonic()
+            async with host_slot(base_url):
+                status_res = await client.post(f"{base_url}/server/status", timeout=adaptive_timeout(server, 'monitor', 'request'))
+            if reused and is_session_expired(status_res): continue
+            record_latency(server, time.monotonic() - request_started)
+            observe('status', server_key(server), time.monotonic() - request_started, ok=status_res.status_code == 200)
+            if status_res.status_code == 200:
+                data = status_res.json()
+                if 'obj' in data: data = data['obj']
+                mem = data.get('mem', {})
+                snapshot['cpu'] = data.get('cpu', 0)
+                snapshot['mem'] = round((mem.get('current', 0) / mem.get('total', 1)) * 100, 1)
+                snapshot['uptime'] = data.get('uptime', 0)
+        except ValueError:
+            # پاسخ JSON نبود؛ احتمالاً صفحه لاگین برگشته
+            if reused: continue
+        except: pass
+        break
+    snapshot['latency'] = round((time.monotonic() - started) * 1000)
+    snapshot['time'] = time.time()
+    return snapshot
+
+def format_age(seconds):
+    if seconds < 60: return f"{int(seconds)} ثانیه پیش"
+    if seconds < 3600: return f"{int(seconds // 60)} دقیقه پیش"
+    return f"{int(seconds // 3600)} ساعت پیش"
+
+def format_status(server, snapshot):
+    if not snapshot: return f"⏳ **{server['name']}**\n(هنوز بررسی نشده)\n🌐 `{server['url']}`"
+    age = f"🕒 {format_age(time.time() - snapshot['time'])}"
+    if not snapshot['online']: return f"🔴 **{server['name']}**\n⚠️ Offline: {snapshot['error']}\n{age}"
+    if snapshot['cpu'] is None: return f"🟢 **{server['name']}**\n(Login OK)\n📶 {snapshot['latency']}ms | {age}\n🌐 `{server['url']}`"
+    status_emoji = "🟢" if snapshot['cpu'] < 80 else "🔴"
+    return (f"{status_emoji} **{server['name']}**\n💻 CPU: {snapshot['cpu']}% | RAM: {snapshot['mem']}%\n"
+            f"⏳ Uptime: {snapshot['uptime']//86400}d | 📶 {snapshot['latency']}ms\n{age}\n🌐 `{server['url']}`")
+
+# --- مانیتورینگ پس‌زمینه ---
+# آخرین وضعیت هر سرور (بر اساس id) که منوی مانیتورینگ بدون انتظار از آن نمایش داده می‌شود
+STATUS_SNAPSHOTS = {}
+_monitor_lock = asyncio.Lock()
+
+async def poll_all_status():
+    """دریافت وضعیت همه سرورها با سقف هم‌زمانی؛ اجرای هم‌زمان دوم منتظر اجرای قبلی می‌ماند"""
+    if _monitor_lock.locked():
+        async with _monitor_lock: return
+    async with _monitor_lock:
+        servers = all_servers()
+        semaphore = asyncio.Semaphore(MONITOR_CONCURRENCY)
+        async def poll(server):
+            if not circuit_allows(server): return
+            async with semaphore:
+                try:
+                    snapshot = await get_status_async(server)
+                    STATUS_SNAPSHOTS[server['id']] = snapshot
+                    record_result(server, snapshot['online'])
+                except Exception as e:
+                    record_result(server, False)
+                    logger.error(f"Status poll failed for {server['name']}: {e}")
+        await asyncio.gather(*[poll(s) for s in servers])
+        known = {s['id'] for s in all_servers()}
+        for server_id in [k for k in STATUS_SNAPSHOTS if k not in known]: del STATUS_SNAPSHOTS[server_id]
+
+        rows = []
+        for server in servers:
+            snap = STATUS_SNAPSHOTS.get(server['id'])
+            if not snap or not snap['online']: continue
+            rows.append((server['id'], snap['time'], 'status_latency', snap['latency']))
+            if snap['cpu'] is not None:
+                rows += [(server['id'], snap['time'], 'cpu', snap['cpu']), (server['id'], snap['time'], 'mem', snap['mem'])]
+        await record_metrics(rows)
+
+async def monitor_job(context):
+    await poll_all_status()
+
+# --- ذخیره متریک‌ها (سری زمانی در SQLite) ---
+# نمونه‌های خام تا METRICS_RAW_HOURS نگه داشته می‌شوند و خلاصه ساعتی (avg/min/max) تا METRICS_RETENTION_DAYS.
+# همه دسترسی‌ها از یک ترد جداگانه انجام می‌شود تا event loop بلاک نشود.
+METRIC_LABELS = {'cpu': "CPU %", 'mem': "RAM %", 'status_latency': "Status ms", 'login_latency': "Login s", 'download_latency': "Download s", 'backup_size': "Backup bytes", 'clients': "Clients"}
+METRICS_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix='metrics')
+_metrics_db = None
+
+def metrics_db():
+    global _metrics_db
+    if _metrics_db is None:
+        _metrics_db = sqlite3.connect(METRICS_FILE, check_same_thread=False)
+        _metrics_db.executescript("""
+            CREATE TABLE IF NOT EXISTS samples (server_id TEXT, ts REAL, metric TEXT, value REAL);
+            CREATE INDEX IF NOT EXISTS samples_idx ON samples (server_id, metric, ts);
+            CREATE TABLE IF NOT EXISTS rollups (server_id TEXT, metric TEXT, hour INTEGER, avg REAL, min REAL, max REAL, count INTEGER,
+                                                PRIMARY KEY (server_id, metric, hour));
+        """)
+    return _metrics_db
+
+def write_samples(rows):
+    db = metrics_db()
+    with db: db.executemany("INSERT INTO samples VALUES (?, ?, ?, ?)", rows)
+
+def rollup_metrics_sync():
+    """تجمیع ساعت‌های کامل‌شده و حذف داده‌های قدیمی‌تر از بازه نگهداری"""
+    db = metrics_db()
+    current_hour = int(time.time() // 3600)
+    # حذف داده خام فقط در مرز ساعت و بعد از تجمیع انجام می‌شود تا هیچ ساعتی ناقص خلاصه نشود
+    cutoff_hour = current_hour - METRICS_RAW_HOURS
+    with db:
+        db.execute("""INSERT OR REPLACE INTO rollups
+                      SELECT server_id, metric, CAST(ts / 3600 AS INTEGER) AS hour, AVG(value), MIN(value), MAX(value), COUNT(*)
+                      FROM samples WHERE ts < ? GROUP BY server_id, metric, hour""",
+                   (current_hour * 3600,))
+        db.execute("DELETE FROM samples WHERE ts < ?", (cutoff_hour * 3600,))
+        db.execute("DELETE FROM rollups WHERE hour < ?", (current_hour - METRICS_RETENTION_DAYS * 24,))
+
+def query_series(server_id, metric, since):
+    """[(ts, value)]؛ از داده خام اگر هنوز موجود باشد، وگرنه از میانگین‌های ساعتی"""
+    db = metrics_db()
+    if since >= time.time() - METRICS_RAW_HOURS * 3600:
+        return db.execute("SELECT ts, value FROM samples WHERE server_id = ? AND metric = ? AND ts >= ? ORDER BY ts",
+                          (server_id, metric, since)).fetchall()
+    return db.execute("SELECT hour * 3600 + 1800, avg FROM rollups WHERE server_id = ? AND metric = ? AND hour >= ? ORDER BY hour",
+                      (server_id, metric, int(since // 3600))).fetchall()
+
+def aggregate_by_server(metric, since):
+    """میانگین وزنی هر سرور در بازه: {server_id: (avg, count)}"""
+    db = metrics_db()
+    current_hour = int(time.time() // 3600)
+    rows = db.execute("""SELECT server_id, SUM(total), SUM(n) FROM (
+                             SELECT server_id, avg * count AS total, count AS n FROM rollups WHERE metric = ? AND hour >= ?
+                             UNION ALL
+                             SELECT server_id, value, 1 FROM samples WHERE metric = ? AND ts >= ?
+                         ) GROUP BY server_id""",
+                      (metric, int(since // 3600), metric, max(since, current_hour * 3600))).fetchall()
+    return {server_id: (total / n, n) for server_id, total, n in rows if n}
+
+async def run_metrics(func, *args):
     loop = asyncio.get_running_loop()
-    return await loop.run_in_executor(None, get_server_status_sync, server)
+    return await loop.run_in_executor(METRICS_EXECUTOR, func, *args)
 
-async def update_job_schedule(application, interval, chat_id):
+async def record_metrics(rows):
+    if not rows: return
+    try: await run_metrics(write_samples, rows)
+    except Exception as e: logger.error(f"Metrics write failed: {e}")
+
+async def metrics_rollup_job(context):
+    try: await run_metrics(rollup_metrics_sync)
+    except Exception as e: logger.error(f"Metrics rollup failed: {e}")
+
+# --- رسم نمودار (PNG بدون کتابخانه خارجی) ---
+def render_chart_png(series, since, until, width=720, height=360, y_max=100):
+    """series: [(points [(ts, value)], (r, g, b))] -> بایت‌های PNG"""
+    left, right, top, bottom = 40, 10, 10, 30
+    pixels = bytearray(b'\xff' * width * height * 3)
+
+    def put(x, y, color):
+        if 0 <= x < width and 0 <= y < height:
+            i = (y * width + x) * 3
+            pixels[i:i + 3] = bytes(color)
+
+    def line(x0, y0, x1, y1, color, thick=1):
+        dx, dy = abs(x1 - x0), -abs(y1 - y0)
+        sx, sy = (1 if x0 < x1 else -1), (1 if y0 < y1 else -1)
+        err = dx + dy
+        while True:
+            for t in range(thick):
+                put(x0, y0 + t, color)
+            if x0 == x1 and y0 == y1: break
+            e2 = 2 * err
+            if e2 >= dy: err += dy; x0 += sx
+            if e2 <= dx: err += dx; y0 += sy
+
+    plot_w, plot_h = width - left - right, height - top - bottom
+    for step in range(5):
+        y = top + plot_h - plot_h * step // 4
+        line(left, y, width - right, y, (225, 225, 225))
+    for step in range(7):
+        x = left + plot_w * step // 6
+        line(x, top, x, top + plot_h, (235, 235, 235))
+    line(left, top, left, top + plot_h, (120, 120, 120))
+    line(left, top + plot_h, width - right, top + plot_h, (120, 120, 120))
+
+    span = max(until - since, 1)
+    for points, color in series:
+        prev = None
+        for ts, value in points:
+            x = left + int((ts - since) / span * plot_w)
+            y = top + plot_h - int(min(max(value, 0), y_max) / y_max * plot_h)
+            if prev: line(prev[0], prev[1], x, y, color, thick=2)
+            prev = (x, y)
+
+    raw = b''.join(b'\x00' + bytes(pixels[y * width * 3:(y + 1) * width * 3]) for y in range(height))
+    def chunk(kind, data): return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff)
+    return (b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0))
+            + chunk(b'IDAT', zlib.compress(raw, 6)) + chunk(b'IEND', b''))
+
+def find_server(text):
+    """پیدا کردن سرور با شناسه یا نام (بدون حساسیت به حروف بزرگ/کوچک)"""
+    text = (text or '').strip().lower()
+    if not text: return None
+    servers = all_servers()
+    for server in servers:
+        if server['id'] == text or server['name'].lower() == text: return server
+    matches = [s for s in servers if s['name'].lower().startswith(text)]
+    return matches[0] if len(matches) == 1 else None
+
+def summarize(points):
+    values = [v for _, v in points]
+    return f"min {min(values):.1f} | avg {sum(values) / len(values):.1f} | max {max(values):.1f}"
+
+async def trend_command(update, context):
+    """/trend <نام سرور> [ساعت]"""
+    if not check_auth(update.effective_user.id): return
+    args = list(context.args)
+    hours = 24
+    if args and args[-1].isdigit(): hours = int(args.pop())
+    server = find_server(" ".join(args))
+    if not server:
+        await update.message.reply_text("استفاده: /trend <نام سرور> [ساعت]\nمثال: /trend Germany 24")
+        return
+    until = time.time()
+    since = until - hours * 3600
+    cpu = await run_metrics(query_series, server['id'], 'cpu', since)
+    mem = await run_metrics(query_series, server['id'], 'mem', since)
+    if not cpu and not mem:
+        await update.message.reply_text(f"📉 برای **{escape_markdown(server['name'])}** در {hours} ساعت اخیر داده‌ای ثبت نشده است.", parse_mode='Markdown')
+        return
+    png = await run_metrics(render_chart_png, [(cpu, (31, 119, 180)), (mem, (255, 127, 14))], since, until)
+    caption = f"📈 **{escape_markdown(server['name'])}** — {hours} ساعت اخیر\n🟦 CPU: {summarize(cpu) if cpu else '-'}\n🟧 RAM: {summarize(mem) if mem else '-'}"
+    await update.message.reply_photo(photo=png, caption=caption, parse_mode='Markdown')
+
+async def slowest_command(update, context):
+    """/slowest [روز] — کندترین پنل‌ها بر اساس زمان لاگین و دانلود"""
+    if not check_auth(update.effective_user.id): return
+    days = int(context.args[0]) if context.args and context.args[0].isdigit() else 7
+    since = time.time() - days * 86400
+    login = await run_metrics(aggregate_by_server, 'login_latency', since)
+    download = await run_metrics(aggregate_by_server, 'download_latency', since)
+    status = await run_metrics(aggregate_by_server, 'status_latency', since)
+    ranking = []
+    for server in all_servers():
+        total = login.get(server['id'], (0, 0))[0] + download.get(server['id'], (0, 0))[0]
+        if total or server['id'] in status: ranking.append((total, server))
+    if not ranking:
+        await update.message.reply_text(f"📉 در {days} روز اخیر داده‌ای ثبت نشده است.")
+        return
+    ranking.sort(key=lambda r: (r[0], status.get(r[1]['id'], (0, 0))[0]), reverse=True)
+    lines = [f"🐢 **کندترین پنل‌ها ({days} روز اخیر)**"]
+    for rank, (total, server) in enumerate(ranking[:10], 1):
+        sid = server['id']
+        lines.append(f"{rank}. **{escape_markdown(server['name'])}** — لاگین {login.get(sid, (0, 0))[0]:.2f}s | دانلود {download.get(sid, (0, 0))[0]:.2f}s | وضعیت {status.get(sid, (0, 0))[0]:.0f}ms")
+    await update.message.reply_text("\n".join(lines), parse_mode='Markdown')
+
+# --- زمان‌بندی (هر سرور/گروه، بازه ثابت یا cron) ---
+# هر «واحد» زمان‌بندی یک گروه (سرورهایی با فیلد group)، یک سرور با زمان‌بندی اختصاصی، یا واحد مشترک
+# default (همه سرورهای بدون گروه و زمان‌بندی، روی بازه سراسری و در یک اجرا) است و job جداگانه دارد.
+# زمان شروع هر واحد با یک jitter ثابت (بر اساس هش نام واحد) در طول بازه پخش می‌شود
+# تا همه واحدها هم‌زمان لاگین/دانلود نکنند؛ داخل واحد پیش‌فرض هم شروع هر سرور در BACKUP_STAGGER ثانیه پخش می‌شود
+# و سقف BACKUP_CONCURRENCY بین همه واحدها مشترک است.
+CRON_FIELDS = [(0, 59), (0, 23), (1, 31), (1, 12), (0, 6)]
+BACKUP_RUNNING = set()
+
+def parse_cron_field(field, low, high):
+    values = set()
+    for part in field.split(','):
+        step = 1
+        if '/' in part:
+            part, step_text = part.split('/', 1)
+            step = int(step_text)
+            if step < 1: raise ValueError(f"bad step in '{field}'")
+        if part == '*': start, end = low, high
+        elif '-' in part:
+            start, end = (int(x) for x in part.split('-', 1))
+        else:
+            start = end = int(part)
+            if step > 1: end = high
+        # روز هفته: 7 هم یعنی یکشنبه (پس 5-7 یعنی جمعه تا یکشنبه)
+        top = 7 if high == 6 else high
+        if not (low <= start <= end <= top): raise ValueError(f"'{field}' out of range {low}-{high}")
+        values.update(v % 7 if high == 6 else v for v in range(start, end + 1, step))
+    return values
+
+def parse_cron(expr):
+    """عبارت cron پنج‌بخشی: دقیقه ساعت روز-ماه ماه روز-هفته (0=یکشنبه)"""
+    fields = expr.split()
+    if len(fields) != 5: raise ValueError("cron needs 5 fields: minute hour day month weekday")
+    parsed = [parse_cron_field(f, low, high) for f, (low, high) in zip(fields, CRON_FIELDS)]
+    parsed.append((fields[2] != '*', fields[4] != '*'))
+    return parsed
+
+def next_cron_time(expr, after):
+    """اولین زمان (naive، به وقت محلی) بعد از after که با عبارت cron جور است"""
+    minutes, hours, days, months, weekdays, (dom_set, dow_set) = parse_cron(expr)
+    t = after.replace(second=0, microsecond=0) + timedelta(minutes=1)
+    limit = t + timedelta(days=366 * 4)
+    while t < limit:
+        if t.month not in months:
+            t = (t.replace(day=1, hour=0, minute=0) + timedelta(days=32)).replace(day=1)
+            continue
+        dom_ok, dow_ok = t.day in days, (t.weekday() + 1) % 7 in weekdays
+        day_ok = (dom_ok or dow_ok) if (dom_set and dow_set) else (dom_ok and dow_ok)
+        if not day_ok:
+            t = t.replace(hour=0, minute=0) + timedelta(days=1)
+            continue
+        if t.hour not in hours:
+            t = t.replace(minute=0) + timedelta(hours=1)
+            continue
+        if t.minute not in minutes:
+            t += timedelta(minutes=1)
+            continue
+        return t
+    raise ValueError(f"cron '{expr}' never matches")
+
+def parse_schedule(text):
+    """'900'، '15m'، '2h'، '1d' یا عبارت cron -> ('interval', ثانیه) یا ('cron', عبارت)"""
+    text = (text or '').strip()
+    match = re.fullmatch(r'(\d+)([smhd]?)', text)
+    if match:
+        seconds = int(match.group(1)) * {'': 1, 's': 1, 'm': 60, 'h': 3600, 'd': 86400}[match.group(2)]
+        if seconds < 60: raise ValueError("minimum interval is 60 seconds")
+        return 'interval', seconds
+    # عبارتی که هرگز اجرا نمی‌شود (مثل 31 فوریه) همین‌جا رد می‌شود، نه موقع ساخت job
+    next_cron_time(text, datetime.now())
+    return 'cron', text
+
+def schedule_unit(server):
+    if server.get('group'): return f"group:{server['group']}"
+    return server['id'] if server.get('schedule') else 'default'
+
+def unit_schedule(unit, servers, settings):
+    if unit == 'default': return 'interval', settings.get('interval', 86400)
+    if unit.startswith('group:'):
+        schedule = settings.get('group_schedules', {}).get(unit[6:])
+        if schedule: return parse_schedule(schedule)
+    for server in servers:
+        if server.get('schedule'): return parse_schedule(server['schedule'])
+    return 'interval', settings.get('interval', 86400)
+
+def jitter(unit, span):
+    return int(hashlib.sha1(unit.encode()).hexdigest(), 16) % max(1, int(span))
+
+def schedule_units():
+    units = OrderedDict()
+    for server in all_servers(): units.setdefault(schedule_unit(server), []).append(server)
+    return units
+
+def schedule_cron_job(job_queue, unit, expr, chat_id):
+    now = datetime.now(TIMEZONE).replace(tzinfo=None)
+    when = TIMEZONE.localize(next_cron_time(expr, now)) + timedelta(seconds=jitter(unit, 60))
+    job_queue.run_once(unit_backup_job, when=when, name=f"backup_{unit}", chat_id=chat_id, data={'unit': unit, 'cron': expr})
+
+def reschedule_backups(application, chat_id=None):
+    """ساخت دوباره همه jobهای بکاپ بر اساس تنظیمات فعلی سرورها/گروه‌ها"""
+    if not chat_id: chat_id = int(config.ADMIN_ID)
     job_queue = application.job_queue
-    current_jobs = job_queue.get_jobs_by_name('backup_job')
-    for job in current_jobs:
-        job.schedule_removal()
-    job_queue.run_repeating(scheduled_backup, interval=interval, first=interval, name='backup_job', chat_id=chat_id)
+    for job in job_queue.jobs():
+        if job.name and (job.name == 'backup_job' or job.name.startswith('backup_')): job.schedule_removal()
+    settings = load_settings()
+    for unit, servers in schedule_units().items():
+        try: kind, value = unit_schedule(unit, servers, settings)
+        except ValueError as e:
+            logger.error(f"Invalid schedule for {unit}: {e}; using default interval")
+            kind, value = 'interval', settings.get('interval', 86400)
+        if kind == 'cron':
+            try:
+                schedule_cron_job(job_queue, unit, value, chat_id)
+                continue
+            except ValueError as e:
+                logger.error(f"Invalid schedule for {unit}: {e}; using default interval")
+                kind, value = 'interval', settings.get('interval', 86400)
+        # فاز ثابت نسبت به ساعت دیواری؛ بعد از ری‌استارت هم زمان اجرای هر واحد تغییر نمی‌کند
+        first = (jitter(unit, value) - time.time()) % value or value
+        job_queue.run_repeating(unit_backup_job, interval=value, first=first, name=f"backup_{unit}", chat_id=chat_id, data={'unit': unit})
+    logger.info(f"Backup jobs scheduled for {len(schedule_units())} unit(s).")
+
+async def unit_backup_job(context):
+    job = context.job
+    unit = job.data['unit']
+    chat_id = job.chat_id if job.chat_id else int(config.ADMIN_ID)
+    if job.data.get('cron'): schedule_cron_job(context.job_queue, unit, job.data['cron'], chat_id)
+    server_ids = [s['id'] for s in all_servers() if schedule_unit(s) == unit]
+    # واحد پیش‌فرض معمولاً بیشتر سرورها را دارد؛ شروع آن‌ها هم مثل واحدها در زمان پخش می‌شود
+    spread = min(BACKUP_STAGGER, load_settings().get('interval', 86400) // 2) if unit == 'default' else 0
+    if server_ids: await run_backup_task(context, chat_id=chat_id, server_ids=server_ids, spread=spread)
+
+async def update_job_schedule(application, interval, chat_id):
+    reschedule_backups(application, chat_id)
     logger.info(f"Schedule updated to every {interval} seconds.")
 
+def describe_schedules():
+    settings = load_settings()
+    lines = []
+    for unit, servers in schedule_units().items():
+        try: kind, value = unit_schedule(unit, servers, settings)
+        except ValueError: kind, value = 'interval', settings.get('interval', 86400)
+        if unit == 'default': name = "🌐 پیش‌فرض"
+        else: name = f"👥 {escape_markdown(unit[6:])}" if unit.startswith('group:') else f"🖥 {escape_markdown(servers[0]['name'])}"
+        when = f"cron `{value}`" if kind == 'cron' else f"هر {value // 60} دقیقه"
+        lines.append(f"{name} ({len(servers)} سرور): {when}")
+    return lines
+
+async def schedule_command(update, context):
+    """/schedule <سرور یا group:نام> <بازه|cron|default>"""
+    if not check_auth(update.effective_user.id): return
+    args = list(context.args)
+    usage = ("استفاده:\n/schedule <سرور> 30m\n/schedule <سرور> */15 * * * *\n/schedule group:<نام> 2h\n/schedule <سرور> default\n"
+             "/group <سرور> <نام گروه|none>")
+    if len(args) < 2:
+        lines = describe_schedules() or ["(سروری وجود ندارد)"]
+        await update.message.reply_text("⏱ **زمان‌بندی فعلی:**\n" + "\n".join(lines) + "\n\n" + usage, parse_mode='Markdown')
+        return
+    target, value = args[0], " ".join(args[1:])
+    try:
+        schedule = None if value == 'default' else value
+        if schedule: parse_schedule(schedule)
+    except ValueError as e:
+        await update.message.reply_text(f"❌ زمان‌بندی نامعتبر: {e}")
+        return
+    if target.startswith('group:'):
+        groups = load_settings().get('group_schedules', {})
+        if schedule: groups[target[6:]] = schedule
+        else: groups.pop(target[6:], None)
+        save_settings(group_schedules=groups)
+    else:
+        server = find_server(target)
+        if not server:
+            await update.message.reply_text("❌ سرور یافت نشد (نام یا شناسه سرور را وارد کنید).")
+            return
+        update_server(server['id'], schedule=schedule)
+    reschedule_backups(context.application, update.effective_chat.id)
+    await update.message.reply_text(f"✅ زمان‌بندی {target}: {value}")
+
+async def group_command(update, context):
+    """/group <سرور> <نام گروه|none>"""
+    if not check_auth(update.effective_user.id): return
+    if len(context.args) != 2:
+        await update.message.reply_text("استفاده: /group <سرور> <نام گروه|none>")
+        return
+    server = find_server(context.args[0])
+    if not server:
+        await update.message.reply_text("❌ سرور یافت نشد.")
+        return
+    group = None if context.args[1] == 'none' else context.args[1]
+    update_server(server['id'], group=group)
+    reschedule_backups(context.application, update.effective_chat.id)
+    await update.message.reply_text(f"✅ گروه {server['name']}: {group or '-'}")
+
 # --- منوها ---
+def format_open_circuits():
+    circuits = open_circuits()
+    if not circuits: return ""
+    lines = [f"⛔ **سرورهای از دسترس خارج (مدار باز): {len(circuits)}**"]
+    for server, remaining in circuits[:10]:
+        lines.append(f"• {escape_markdown(server['name'])} — بررسی بعدی: {'به‌زودی' if remaining < 1 else f'{int(remaining // 60)} دقیقه و {int(remaining % 60)} ثانیه دیگر'}")
+    if len(circuits) > 10: lines.append(f"• ... و {len(circuits) - 10} سرور دیگر")
+    return "\n".join(lines) + "\n\n"
+
 async def show_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     settings = load_settings()
     current_schedule = settings.get("label", "هر 24 ساعت")
+    delivery_label = DELIVERY_LABELS.get(settings.get("delivery"), DELIVERY_LABELS['file'])
+    mode_label = BACKUP_MODE_LABELS.get(settings.get("backup_mode"), BACKUP_MODE_LABELS['full'])
     keyboard = [
         [InlineKeyboardButton("➕ افزودن سرور", callback_data='add_server'), InlineKeyboardButton("📋 مانیتورینگ (ویرایش/حذف)", callback_data='list_servers')],
         [InlineKeyboardButton(f"⏱ زمان‌بندی: {current_schedule}", callback_data='schedule_menu')],
+        [InlineKeyboardButton(f"📦 نحوه ارسال: {delivery_label}", callback_data='toggle_delivery'), InlineKeyboardButton(f"نوع بکاپ: {mode_label}", callback_data='toggle_backup_mode')],
         [InlineKeyboardButton("📤 دریافت تنظیمات (Export)", callback_data='export_settings')],
         [InlineKeyboardButton("🚀 بکاپ‌گیری آنی", callback_data='backup_all')]
     ]
@@ -206,7 +1285,9 @@ async def show_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     msg = (
         f"🔐 **مدیریت بکاپ X-UI**\n"
         f"وضعیت: 🟢 فعال\n"
-        f"تعداد سرورها: {len(load_servers())}\n\n"
+        f"تعداد سرورها: {len(all_servers())}\n\n"
+        f"{format_open_circuits()}"
+        f"{format_upload_queue()}"
         f"⚠️ **تذکر مهم:**\n"
         f"در صورت تغییر نسخه پنل (آپدیت/دانگرید)، حتماً از بخش مانیتورینگ، گزینه **«🔄 آپدیت مسیر»** را بزنید."
     )
@@ -235,87 +1316,854 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if data == 'main_menu': await show_menu(update, context)
     elif data == 'schedule_menu': await show_schedule_menu(update)
     elif data == 'export_settings': await export_config_logic(update, context, chat_id=query.message.chat_id)
+    elif data == 'toggle_delivery':
+        current = load_settings().get('delivery', 'file')
+        save_settings(delivery='archive' if current == 'file' else 'file')
+        await show_menu(update, context)
+    elif data == 'toggle_backup_mode':
+        current = load_settings().get('backup_mode', 'full')
+        save_settings(backup_mode='incremental' if current == 'full' else 'full')
+        await show_menu(update, context)
     
     elif data.startswith('set_time_'):
         seconds = int(data.split('_')[2])
         labels = {60: "1 دقیقه", 300: "5 دقیقه", 600: "10 دقیقه", 900: "15 دقیقه", 1800: "30 دقیقه", 3600: "1 ساعت", 21600: "6 ساعت", 43200: "12 ساعت", 86400: "24 ساعت"}
         label = labels.get(seconds, f"{seconds} ثانیه")
-        save_settings(seconds, label)
+        save_settings(interval=seconds, label=label)
         await update_job_schedule(context.application, seconds, query.message.chat_id)
         await query.edit_message_text(f"✅ زمان‌بندی: **{label}**", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 بازگشت", callback_data='main_menu')]]), parse_mode='Markdown')
 
-    elif data == 'list_servers':
-        servers = load_servers()
+    elif data in ('list_servers', 'refresh_status'):
+        servers = all_servers()
         if not servers: 
             await query.edit_message_text("لیست خالی است.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 بازگشت", callback_data='main_menu')]]))
             return
-        await query.message.reply_text("⏳ دریافت وضعیت (Rapid Mode)...")
-        tasks = [get_status_async(s) for s in servers]
-        results = await asyncio.gather(*tasks)
-        for idx, status_text in enumerate(results):
+        if data == 'refresh_status':
+            await query.message.reply_text("⏳ در حال بروزرسانی وضعیت همه سرورها...")
+            await poll_all_status()
+        for server in servers:
             keyboard = [
-                [InlineKeyboardButton("✏️ ویرایش (User/Pass)", callback_data=f"edit_srv_{idx}"), InlineKeyboardButton("🔄 آپدیت مسیر", callback_data=f"rescan_{idx}")],
-                [InlineKeyboardButton(f"🗑 حذف {servers[idx]['name']}", callback_data=f"del_{idx}")]
+                [InlineKeyboardButton("✏️ ویرایش (User/Pass)", callback_data=f"edit_srv_{server['id']}"), InlineKeyboardButton("🔄 آپدیت مسیر", callback_data=f"rescan_{server['id']}")],
+                [InlineKeyboardButton(f"🗑 حذف {server['name']}", callback_data=f"del_{server['id']}")]
             ]
-            await query.message.reply_text(status_text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='Markdown')
-        await query.message.reply_text("--- پایان ---", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 منو", callback_data='main_menu')]]))
+            await query.message.reply_text(format_status(server, STATUS_SNAPSHOTS.get(server['id'])), reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='Markdown')
+        await query.message.reply_text("--- پایان ---", reply_markup=InlineKeyboardMarkup([
+            [InlineKeyboardButton("🔄 بروزرسانی وضعیت", callback_data='refresh_status')],
+            [InlineKeyboardButton("🔙 منو", callback_data='main_menu')]
+        ]))
 
     elif data == 'backup_all':
         await query.message.reply_text("⏳ بکاپ‌گیری شروع شد...")
-        asyncio.create_task(run_backup_task(context, chat_id=query.message.chat_id))
+        asyncio.create_task(run_backup_task(context, chat_id=query.message.chat_id, force=True))
 
     elif data.startswith('del_'):
-        idx = int(data.split('_')[1])
-        servers = load_servers()
-        if 0 <= idx < len(servers):
-            removed = servers.pop(idx)
-            save_servers(servers)
+        removed = remove_server(data.split('_', 1)[1])
+        if removed:
+            reschedule_backups(context.application)
             await query.edit_message_text(f"✅ سرور {removed['name']} حذف شد.")
 
     elif data.startswith('rescan_'):
-        idx = int(data.split('_')[1])
-        servers = load_servers()
-        if 0 <= idx < len(servers):
-            server = servers[idx]
+        server = get_server(data.split('_', 1)[1])
+        if server:
             await query.message.reply_text(f"🔍 در حال اسکن مجدد مسیر برای **{server['name']}**...")
-            filepath, new_path = await perform_backup_async(server, mode='test')
+            info = {}
+            filepath, new_path = await perform_backup_async(server, mode='test', info=info)
             if filepath:
                 os.remove(filepath)
+                # اگر مسیر ذخیره‌شده کار نکرده باشد نسخه تازه شناسایی شده (حتی None) جایگزین نسخه قدیمی می‌شود
+                panel_version = info['panel_version'] if 'panel_version' in info else server.get('panel_version')
                 if server.get('db_path') != new_path:
-                    server['db_path'] = new_path
-                    servers[idx] = server
-                    save_servers(servers)
+                    update_server(server['id'], db_path=new_path, panel_version=panel_version)
                     await query.message.reply_text(f"✅ **مسیر آپدیت شد!**\nمسیر جدید: `{new_path}`", parse_mode='Markdown')
+                    if panel_version:
+                        await query.message.reply_text(f"🔍 بررسی گروهی سرورهای هم‌نسخه (`{panel_version}`)...", parse_mode='Markdown')
+                        updated = await revalidate_version_path(panel_version, new_path, exclude_id=server['id'])
+                        await query.message.reply_text(f"✅ مسیر {updated} سرور دیگر هم به‌روز شد.")
                 else:
+                    if panel_version != server.get('panel_version'): update_server(server['id'], panel_version=panel_version)
                     await query.message.reply_text(f"✅ مسیر فعلی صحیح است.\n`{new_path}`", parse_mode='Markdown')
             else:
                 await query.message.reply_text(f"❌ خطا: {new_path}")
 
+# --- فشرده‌سازی و آرشیو (در Worker Pool اجرا می‌شوند) ---
+def estimated_deflated_size(filepath, samples=COMPRESS_SAMPLES):
+    """تخمین اندازه فشرده از روی چند تکه نمونه در طول فایل؛ هر فایل فقط یک بار (در build_archive) کامل فشرده می‌شود
+    و اگر تخمین کمتر از واقع باشد build_archive خروجی را تکه‌تکه می‌کند"""
+    size = os.path.getsize(filepath)
+    step = max(DOWNLOAD_CHUNK_SIZE, size // samples)
+    raw = packed = 0
+    with open(filepath, 'rb') as f:
+        for offset in range(0, size, step)[:samples]:
+            f.seek(offset)
+            chunk = f.read(DOWNLOAD_CHUNK_SIZE)
+            compressor = zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, -15)
+            raw += len(chunk)
+            packed += len(compressor.compress(chunk)) + len(compressor.flush())
+    return int(size * packed / raw) if raw else 0
+
+def plan_archives(entries, limit):
+    """entries: [(arcname, filepath, estimated_size)] -> گروه‌هایی که هر کدام (به تخمین) زیر سقف می‌مانند"""
+    groups = []
+    for entry in sorted(entries, key=lambda e: e[2], reverse=True):
+        cost = entry[2] + 128 + 2 * len(entry[0].encode())
+        for group in groups:
+            if group['size'] + cost <= limit:
+                group['entries'].append(entry)
+                group['size'] += cost
+                break
+        else:
+            groups.append({'entries': [entry], 'size': cost})
+    return [g['entries'] for g in groups]
+
+def build_archive(entries, out_path, limit):
+    """ساخت یک فایل zip؛ اگر باز هم از سقف بزرگ‌تر شد به تکه‌های .001، .002 ... تقسیم می‌شود"""
+    with zipfile.ZipFile(out_path, 'w', zipfile.ZIP_DEFLATED, compresslevel=COMPRESS_LEVEL) as zf:
+        for arcname, filepath, _ in entries: zf.write(filepath, arcname)
+    if os.path.getsize(out_path) <= limit: return [out_path]
+
+    parts = []
+    with open(out_path, 'rb') as src:
+        for index, chunk in enumerate(iter(lambda: src.read(limit), b''), 1):
+            part_path = f"{out_path}.{index:03d}"
+            with open(part_path, 'wb') as dst: dst.write(chunk)
+            parts.append(part_path)
+    os.remove(out_path)
+    return parts
+
+async def create_archives(items, stamp, out_dir=BACKUP_DIR):
+    """items: [(arcname, filepath)] -> لیست گروه‌ها به صورت (نام‌ها، فایل‌های نهایی)"""
+    loop = asyncio.get_running_loop()
+    sizes = await asyncio.gather(*[loop.run_in_executor(COMPRESS_EXECUTOR, estimated_deflated_size, fp) for _, fp in items])
+    groups = plan_archives([(name, fp, size) for (name, fp), size in zip(items, sizes)], ARCHIVE_PART_LIMIT)
+    jobs = []
+    for index, group in enumerate(groups, 1):
+        suffix = f"_{index}" if len(groups) > 1 else ""
+        out_path = os.path.join(out_dir, f"backup_{stamp}{suffix}.zip")
+        jobs.append(loop.run_in_executor(COMPRESS_EXECUTOR, build_archive, group, out_path, ARCHIVE_PART_LIMIT))
+    outputs = await asyncio.gather(*jobs)
+    return [([name for name, _, _ in group], paths) for group, paths in zip(groups, outputs)]
+
+def unique_arcname(name, used):
+    base, ext = os.path.splitext(name)
+    candidate, n = name, 2
+    while candidate in used:
+        candidate = f"{base}_{n}{ext}"
+        n += 1
+    used.add(candidate)
+    return candidate
+
+# --- بکاپ افزایشی (دیف صفحه‌ای SQLite) ---
+# فرمت فایل دلتا: DELTA_MAGIC + هدر (page_size, new_size, sha256 پایه, sha256 جدید, تعداد صفحات)
+# و سپس رکوردهای (شماره صفحه + محتوای صفحه) به صورت zlib
+def sqlite_page_size(filepath):
+    with open(filepath, 'rb') as f: header = f.read(100)
+    size = int.from_bytes(header[16:18], 'big')
+    if size == 1: return 65536
+    return size if size >= 512 and size & (size - 1) == 0 else 4096
+
+def baseline_path(server): return os.path.join(BASELINE_DIR, os.path.basename(backup_file_path(server)))
+
+def create_delta(base_path, new_path, out_path):
+    """صفحات تغییرکرده new نسبت به base را در out می‌نویسد؛ خروجی: (اندازه دلتا, sha256 پایه)"""
+    page_size = sqlite_page_size(new_path)
+    new_size = os.path.getsize(new_path)
+    base_hash, new_hash = hashlib.sha256(), hashlib.sha256()
+    compressor = zlib.compressobj(COMPRESS_LEVEL)
+    changed = 0
+    with open(base_path, 'rb') as base, open(new_path, 'rb') as new, open(out_path, 'wb') as out:
+        out.write(DELTA_MAGIC + b'\0' * DELTA_HEADER.size)
+        page_no = 0
+        for new_page in iter(lambda: new.read(page_size), b''):
+            base_page = base.read(page_size)
+            base_hash.update(base_page)
+            new_hash.update(new_page)
+            if new_page != base_page:
+                out.write(compressor.compress(struct.pack('>I', page_no) + new_page))
+                changed += 1
+            page_no += 1
+        for rest in iter(lambda: base.read(DOWNLOAD_CHUNK_SIZE), b''): base_hash.update(rest)
+        out.write(compressor.flush())
+        out.seek(len(DELTA_MAGIC))
+        out.write(DELTA_HEADER.pack(page_size, new_size, base_hash.digest(), new_hash.digest(), changed))
+    return os.path.getsize(out_path), base_hash.hexdigest()
+
+def apply_delta(base_path, delta_path, out_path):
+    """ساخت نسخه جدید از روی base و یک فایل دلتا؛ هش پایه و نتیجه بررسی می‌شود"""
+    with open(delta_path, 'rb') as delta:
+        if delta.read(len(DELTA_MAGIC)) != DELTA_MAGIC: raise ValueError(f"{delta_path}: not a delta file")
+        page_size, new_size, base_sha, new_sha, count = DELTA_HEADER.unpack(delta.read(DELTA_HEADER.size))
+        if file_digest(base_path) != base_sha.hex(): raise ValueError(f"{delta_path}: base does not match (wrong order or missing delta)")
+        shutil.copyfile(base_path, out_path)
+        decompressor = zlib.decompressobj()
+        buf, applied = b'', 0
+        with open(out_path, 'r+b') as out:
+            def apply_records(buf):
+                nonlocal applied
+                while len(buf) >= 4:
+                    page_no = struct.unpack('>I', buf[:4])[0]
+                    length = min(page_size, new_size - page_no * page_size)
+                    if len(buf) < 4 + length: break
+                    out.seek(page_no * page_size)
+                    out.write(buf[4:4 + length])
+                    buf = buf[4 + length:]
+                    applied += 1
+                return buf
+            for chunk in iter(lambda: delta.read(DOWNLOAD_CHUNK_SIZE), b''):
+                buf = apply_records(buf + decompressor.decompress(chunk))
+            buf = apply_records(buf + decompressor.flush())
+            out.truncate(new_size)
+    if applied != count or buf: raise ValueError(f"{delta_path}: truncated delta")
+    if file_digest(out_path) != new_sha.hex(): raise ValueError(f"{delta_path}: restored database hash mismatch")
+
+def restore_backup_chain(full_path, delta_paths, out_path):
+    """بازسازی دیتابیس کامل از آخرین بکاپ کامل + دلتاهای بعد از آن (به ترتیب)"""
+    work_path = f"{out_path}.work"
+    shutil.copyfile(full_path, out_path)
+    for delta_path in delta_paths:
+        apply_delta(out_path, delta_path, work_path)
+        os.replace(work_path, out_path)
+    return out_path
+
+async def prepare_incremental(server, db_path, size, last, now):
+    """تصمیم بین ارسال دلتا یا بکاپ کامل؛ خروجی دیکشنری فایل قابل ارسال"""
+    base = baseline_path(server)
+    chain = last.get('chain', 0)
+    if last.get('sha256') and os.path.exists(base) and chain + 1 < INCREMENTAL_FULL_EVERY:
+        delta_path = os.path.join(BACKUP_DIR, f"{os.path.basename(db_path)[:-3]}_{now.strftime('%Y%m%d_%H%M%S')}.xdelta")
+        try:
+            loop = asyncio.get_running_loop()
+            delta_size, base_sha = await loop.run_in_executor(COMPRESS_EXECUTOR, create_delta, base, db_path, delta_path)
+            if base_sha == last['sha256'] and delta_size <= size * INCREMENTAL_MAX_RATIO:
+                name = f"{backup_file_name(server)[:-3]}_{now.strftime('%Y%m%d_%H%M%S')}_d{chain + 1:03d}.xdelta"
+                return {'filepath': delta_path, 'name': name, 'kind': 'delta', 'chain': chain + 1, 'base_sha': base_sha}
+        except Exception as e:
+            logger.error(f"Delta failed for {server['name']}: {e}")
+        if os.path.exists(delta_path): os.remove(delta_path)
+    return {'filepath': db_path, 'name': backup_file_name(server), 'kind': 'full', 'chain': 0}
+
+def finish_backup(server, result, state, ok):
+    """ثبت نتیجه: در صورت موفقیت وضعیت (بلافاصله روی دیسک) و Baseline به‌روز می‌شود؛ فایل‌های موقت همیشه پاک می‌شوند.
+    وضعیت با نسخه روی دیسک ادغام می‌شود چون اجراهای دیگر و صف ارسال هم‌زمان آن را تغییر می‌دهند."""
+    if ok:
+        state[server_key(server)] = result['record']
+        save_backup_state({**load_backup_state(), server_key(server): result['record']})
+        if result.get('baseline'):
+            os.makedirs(BASELINE_DIR, exist_ok=True)
+            os.replace(result['baseline'], baseline_path(server))
+    for fp in result.get('files', []):
+        try: os.remove(fp)
+        except OSError: pass
+
+def backup_caption(server, upload, now):
+    # کپشن در صف با Markdown ارسال می‌شود؛ نامی مثل de_1 نباید باعث خطای parse شود
+    name = escape_markdown(server['name'])
+    caption = f"📦 **{name}**"
+    if upload['kind'] == 'delta': caption = f"🧩 **{name}** (افزایشی #{upload['chain']})"
+    caption += f"\n📅 {now.strftime('%Y-%m-%d')}\n⏰ {now.strftime('%H:%M:%S')}"
+    if upload['kind'] == 'delta': caption += f"\n🔗 پایه: `{upload['base_sha'][:12]}`"
+    return caption + format_db_summary(upload.get('summary'))
+
+# --- بررسی سلامت و خلاصه دیتابیس ---
+# در Process جداگانه اجرا می‌شود تا quick_check دیتابیس‌های بزرگ حلقه رویداد ربات را کند نکند
+_verify_executor = None
+
+def verify_database(filepath):
+    """باز کردن فقط‌خواندنی، PRAGMA quick_check و استخراج خلاصه (تعداد اینباند، کاربر و کل ترافیک)"""
+    try:
+        conn = sqlite3.connect(f"file:{os.path.abspath(filepath)}?mode=ro&immutable=1", uri=True)
+    except sqlite3.Error as e: return {'ok': False, 'error': str(e)}
+    try:
+        problems = [row[0] for row in conn.execute("PRAGMA quick_check(5)")]
+        if problems != ['ok']: return {'ok': False, 'error': "; ".join(problems)}
+        tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+        summary = {'ok': True, 'inbounds': None, 'clients': None, 'traffic': None}
+        if 'inbounds' in tables:
+            inbounds = conn.execute("SELECT up, down, settings FROM inbounds").fetchall()
+            summary['inbounds'] = len(inbounds)
+            summary['traffic'] = sum((up or 0) + (down or 0) for up, down, _ in inbounds)
+            clients = 0
+            for _, _, settings in inbounds:
+                try: clients += len(json.loads(settings or '{}').get('clients') or [])
+                except (ValueError, AttributeError): pass
+            summary['clients'] = clients
+        if not summary['clients'] and 'client_traffics' in tables:
+            summary['clients'] = conn.execute("SELECT COUNT(*) FROM client_traffics").fetchone()[0]
+        return summary
+    except sqlite3.Error as e: return {'ok': False, 'error': str(e)}
+    finally: conn.close()
+
+async def run_verify(filepath):
+    global _verify_executor
+    if _verify_executor is None:
+        # fork در حالی که Threadهای دیگر (metrics/snapshot/compress) قفل sqlite یا logging را دارند ممکن است Process فرزند را قفل کند
+        method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+        _verify_executor = ProcessPoolExecutor(max_workers=VERIFY_WORKERS, mp_context=multiprocessing.get_context(method))
+    loop = asyncio.get_running_loop()
+    try: return await loop.run_in_executor(_verify_executor, verify_database, filepath)
+    except BrokenProcessPool:
+        # اگر یک Worker از کار افتاد، Pool بعدی از نو ساخته می‌شود
+        _verify_executor = None
+        return {'ok': False, 'error': "verification worker crashed"}
+
+def shutdown_verify_executor():
+    if _verify_executor: _verify_executor.shutdown(wait=False, cancel_futures=True)
+
+def format_db_summary(summary):
+    if not summary or summary.get('inbounds') is None: return ""
+    return f"\n👥 اینباند: {summary['inbounds']} | کاربر: {summary['clients']}\n📊 ترافیک کل: {format_size(summary['traffic'])}"
+
+def client_drop(previous, summary):
+    """(قبلی, فعلی) اگر تعداد کاربران بیش از CLIENT_DROP_ALERT کم شده باشد، وگرنه None"""
+    before, after = (previous or {}).get('clients'), summary.get('clients')
+    if not CLIENT_DROP_ALERT or not before or after is None: return None
+    return (before, after) if after < before * (1 - CLIENT_DROP_ALERT) else None
+
+# --- مخزن محلی Snapshot ---
+# هر دیتابیس کامل دانلودشده (در صورت تغییر) با لینک سخت در SNAPSHOT_DIR/<شناسه سرور>/ نگه داشته می‌شود
+# و فهرست آن (سرور، زمان، حجم، هش) در index.db ثبت می‌شود؛ هرس در پس‌زمینه انجام می‌شود.
+SNAPSHOT_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix='snapshots')
+_snapshot_db = None
+
+def snapshot_db():
+    global _snapshot_db
+    if _snapshot_db is None:
+        os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+        _snapshot_db = sqlite3.connect(os.path.join(SNAPSHOT_DIR, "index.db"), check_same_thread=False)
+        _snapshot_db.executescript("""
+            CREATE TABLE IF NOT EXISTS snapshots (id INTEGER PRIMARY KEY, server_id TEXT, ts REAL, size INTEGER, sha256 TEXT, path TEXT);
+            CREATE INDEX IF NOT EXISTS snapshots_idx ON snapshots (server_id, ts);
+        """)
+    return _snapshot_db
+
+async def run_snapshots(func, *args):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(SNAPSHOT_EXECUTOR, func, *args)
+
+def add_snapshot_sync(server_id, filepath, digest, ts):
+    """اگر محتوا با آخرین Snapshot همان سرور فرق داشته باشد، فایل لینک (یا کپی) و ثبت می‌شود"""
+    db = snapshot_db()
+    last = db.execute("SELECT sha256 FROM snapshots WHERE server_id = ? ORDER BY ts DESC LIMIT 1", (server_id,)).fetchone()
+    if last and last[0] == digest: return None
+    folder = os.path.join(SNAPSHOT_DIR, server_id)
+    os.makedirs(folder, exist_ok=True)
+    path = os.path.join(folder, f"{datetime.fromtimestamp(ts).strftime('%Y%m%d_%H%M%S')}_{digest[:8]}.db")
+    try: os.link(filepath, path)
+    except OSError: shutil.copyfile(filepath, path)
+    with db:
+        return db.execute("INSERT INTO snapshots (server_id, ts, size, sha256, path) VALUES (?, ?, ?, ?, ?)",
+                          (server_id, ts, os.path.getsize(path), digest, path)).lastrowid
+
+def snapshot_keep_ids(rows, now):
+    """rows: [(id, ts)] یک سرور به ترتیب نزولی زمان -> شناسه‌هایی که طبق سیاست لایه‌ای می‌مانند
+    (جدیدترین Snapshot هر ساعت / روز / هفته بسته به سن آن)"""
+    keep, buckets = set(), set()
+    for snap_id, ts in rows:
+        age, moment = now - ts, datetime.fromtimestamp(ts)
+        if age < SNAPSHOT_HOURLY_HOURS * 3600: bucket = ('hour', moment.strftime('%Y%m%d%H'))
+        elif age < SNAPSHOT_DAILY_DAYS * 86400: bucket = ('day', moment.strftime('%Y%m%d'))
+        else: bucket = ('week',) + tuple(moment.isocalendar()[:2])
+        if bucket not in buckets:
+            buckets.add(bucket)
+            keep.add(snap_id)
+    return keep
+
+def prune_snapshots_sync():
+    """حذف Snapshotهای خارج از سیاست لایه‌ای و سپس قدیمی‌ترین‌ها تا رسیدن به SNAPSHOT_MAX_BYTES؛
+    آخرین Snapshot هر سرور هیچ‌وقت حذف نمی‌شود. خروجی: (تعداد حذف‌شده, حجم باقی‌مانده)"""
+    db = snapshot_db()
+    rows = db.execute("SELECT id, server_id, ts, size, path FROM snapshots ORDER BY ts DESC").fetchall()
+    by_server = {}
+    for row in rows: by_server.setdefault(row[1], []).append(row)
+    keep = set()
+    for server_rows in by_server.values(): keep |= snapshot_keep_ids([(r[0], r[2]) for r in server_rows], time.time())
+    newest = {server_rows[0][0] for server_rows in by_server.values()}
+    total = sum(r[3] for r in rows if r[0] in keep)
+    for row in reversed(rows):
+        if total <= SNAPSHOT_MAX_BYTES: break
+        if row[0] in keep and row[0] not in newest:
+            keep.discard(row[0])
+            total -= row[3]
+    doomed = [r for r in rows if r[0] not in keep]
+    for row in doomed:
+        try: os.remove(row[4])
+        except OSError: pass
+    with db: db.executemany("DELETE FROM snapshots WHERE id = ?", [(r[0],) for r in doomed])
+    return len(doomed), total
+
+def list_snapshots_sync(server_id, limit=10):
+    return snapshot_db().execute("SELECT id, ts, size, sha256, path FROM snapshots WHERE server_id = ? ORDER BY ts DESC LIMIT ?",
+                                 (server_id, limit)).fetchall()
+
+def find_snapshot_sync(server_id, query):
+    """query: latest | شناسه | YYYY-MM-DD [HH:MM] (آخرین Snapshot تا آن لحظه)"""
+    db = snapshot_db()
+    columns = "SELECT id, ts, size, sha256, path FROM snapshots WHERE server_id = ?"
+    if query in ('', 'latest'): return db.execute(f"{columns} ORDER BY ts DESC LIMIT 1", (server_id,)).fetchone()
+    if query.isdigit(): return db.execute(f"{columns} AND id = ?", (server_id, int(query))).fetchone()
+    for fmt, span in (('%Y-%m-%d %H:%M', 60), ('%Y-%m-%d', 86400)):
+        try: until = datetime.strptime(query, fmt).timestamp() + span
+        except ValueError: continue
+        return db.execute(f"{columns} AND ts < ? ORDER BY ts DESC LIMIT 1", (server_id, until)).fetchone()
+    raise ValueError(query)
+
+async def snapshot_prune_job(context):
+    try:
+        removed, total = await run_snapshots(prune_snapshots_sync)
+        if removed: logger.info(f"Pruned {removed} snapshot(s); store now {format_size(total)}")
+    except Exception as e: logger.error(f"Snapshot prune failed: {e}")
+
+async def snapshot_command(update, context):
+    """/snapshot <سرور> [latest|شناسه|YYYY-MM-DD [HH:MM]|list]"""
+    if not check_auth(update.effective_user.id): return
+    if not SNAPSHOT_STORE:
+        await update.message.reply_text("💤 مخزن محلی غیرفعال است. برای فعال‌سازی در config.py مقدار SNAPSHOT_STORE = True را تنظیم کنید.")
+        return
+    args = list(context.args)
+    # نام سرور ممکن است فاصله داشته باشد؛ طولانی‌ترین پیشوندی که سرور را پیدا کند انتخاب می‌شود
+    server, query = None, ''
+    for i in range(len(args), 0, -1):
+        server = find_server(" ".join(args[:i]))
+        if server:
+            query = " ".join(args[i:])
+            break
+    if not server:
+        await update.message.reply_text("استفاده:\n/snapshot <سرور> list\n/snapshot <سرور> [latest]\n/snapshot <سرور> <شناسه>\n/snapshot <سرور> 2024-05-01 [14:00]")
+        return
+    if query == 'list':
+        rows = await run_snapshots(list_snapshots_sync, server['id'])
+        if not rows:
+            await update.message.reply_text(f"📭 برای {server['name']} هنوز Snapshot ذخیره نشده است.")
+            return
+        lines = [f"🗄 **Snapshotهای {escape_markdown(server['name'])}:**"]
+        for snap_id, ts, size, digest, _ in rows:
+            lines.append(f"`#{snap_id}` {datetime.fromtimestamp(ts).strftime('%Y-%m-%d %H:%M')} — {format_size(size)} — `{digest[:12]}`")
+        await update.message.reply_text("\n".join(lines), parse_mode='Markdown')
+        return
+    try: row = await run_snapshots(find_snapshot_sync, server['id'], query)
+    except ValueError:
+        await update.message.reply_text("❌ زمان نامعتبر. نمونه: 2024-05-01 یا 2024-05-01 14:00")
+        return
+    if not row or not os.path.exists(row[4]):
+        await update.message.reply_text(f"📭 Snapshot مورد نظر برای {server['name']} پیدا نشد.")
+        return
+    snap_id, ts, size, digest, path = row
+    if os.path.getsize(path) > TELEGRAM_UPLOAD_LIMIT:
+        await update.message.reply_text(f"❌ Snapshot #{snap_id} ({format_size(os.path.getsize(path))}) از سقف ارسال تلگرام ({format_size(TELEGRAM_UPLOAD_LIMIT)}) بزرگ‌تر است.\n💾 فایل روی سرور ربات: {path}")
+        return
+    moment = datetime.fromtimestamp(ts)
+    caption = f"🗄 **{escape_markdown(server['name'])}** (Snapshot #{snap_id})\n📅 {moment.strftime('%Y-%m-%d')}\n⏰ {moment.strftime('%H:%M:%S')}\n💾 {format_size(size)}\n🔑 `{digest[:12]}`"
+    try:
+        with open(path, 'rb') as f:
+            await update.message.reply_document(document=f, filename=f"{backup_file_name(server)[:-3]}_{moment.strftime('%Y%m%d_%H%M%S')}.db",
+                                                caption=caption, parse_mode='Markdown', read_timeout=UPLOAD_TIMEOUT, write_timeout=UPLOAD_TIMEOUT)
+    except Exception as e:
+        logger.error(f"Snapshot #{snap_id} of {server['name']} could not be sent: {e}")
+        await update.message.reply_text(f"❌ ارسال Snapshot #{snap_id} ناموفق بود:\n{e}\n💾 فایل روی سرور ربات: {path}")
+
+# --- صف ارسال تلگرام ---
+# فایل‌ها قبل از ورود به صف به UPLOAD_DIR منتقل می‌شوند و خود صف در UPLOAD_QUEUE_FILE ذخیره می‌شود
+# تا ری‌استارت ربات یا خطای شبکه هیچ بکاپی را از بین نبرد. یک Worker آن‌ها را با رعایت محدودیت نرخ ارسال می‌کند.
+UPLOAD_QUEUE = []
+UPLOAD_HISTORY = deque(maxlen=200)  # (زمان پایان, حجم, مدت ارسال)
+_upload_wakeup = None
+_upload_worker = None
+_send_lock = None
+_last_send = {}
+_flood_until = 0.0
+
+def load_upload_queue():
+    if not os.path.exists(UPLOAD_QUEUE_FILE): return []
+    try:
+        with open(UPLOAD_QUEUE_FILE, 'r') as f: queue = json.load(f)
+    except Exception as e:
+        # فایل خراب کنار گذاشته می‌شود تا روی آن نوشته نشود؛ فایل‌های بکاپ در UPLOAD_DIR باقی می‌مانند
+        logger.error(f"Upload queue unreadable ({e}); moved to {UPLOAD_QUEUE_FILE}.bad")
+        os.replace(UPLOAD_QUEUE_FILE, f"{UPLOAD_QUEUE_FILE}.bad")
+        return []
+    missing = [item for item in queue if not os.path.exists(item['path'])]
+    for item in missing: logger.error(f"Queued upload {item['filename']} lost its file ({item['path']}); dropped.")
+    return [item for item in queue if item not in missing]
+
+def save_upload_queue():
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(UPLOAD_QUEUE_FILE)), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as f: json.dump(UPLOAD_QUEUE, f, indent=4)
+        os.replace(tmp_path, UPLOAD_QUEUE_FILE)
+    except:
+        if os.path.exists(tmp_path): os.remove(tmp_path)
+        raise
+
+def enqueue_upload(chat_id, filepath, caption, filename=None, keys=(), keep_source=False):
+    """فایل به پوشه صف منتقل می‌شود (با keep_source یک لینک/کپی ساخته می‌شود و اصل فایل سر جایش می‌ماند).
+    keys: کلید سرورهایی که این فایل بکاپ آن‌هاست؛ در صورت شکست دائمی وضعیتشان باطل می‌شود."""
+    os.makedirs(UPLOAD_DIR, exist_ok=True)
+    item_id = uuid.uuid4().hex[:12]
+    path = os.path.join(UPLOAD_DIR, f"{item_id}_{os.path.basename(filepath)}")
+    if keep_source:
+        try: os.link(filepath, path)
+        except OSError: shutil.copyfile(filepath, path)
+    else: os.replace(filepath, path)
+    item = {'id': item_id, 'chat_id': chat_id, 'path': path, 'filename': filename or os.path.basename(filepath), 'caption': caption,
+            'keys': list(keys), 'size': os.path.getsize(path), 'attempts': 0, 'next_at': 0, 'queued_at': time.time()}
+    UPLOAD_QUEUE.append(item)
+    save_upload_queue()
+    if _upload_wakeup: _upload_wakeup.set()
+    return item
+
+def note_flood(error):
+    """RetryAfter کل ربات را متوقف می‌کند، نه فقط همان چت"""
+    global _flood_until
+    delay = error.retry_after.total_seconds() if isinstance(error.retry_after, timedelta) else float(error.retry_after)
+    _flood_until = max(_flood_until, time.monotonic() + delay)
+    return delay
+
+async def telegram_slot(chat_id):
+    """صبر تا رسیدن نوبت ارسال (فاصله بین پیام‌های یک چت، کل ربات و دوره Flood Control)"""
+    global _send_lock
+    if _send_lock is None: _send_lock = asyncio.Lock()
+    async with _send_lock:
+        ready = max(_last_send.get(chat_id, 0) + TELEGRAM_CHAT_INTERVAL, _last_send.get('*', 0) + TELEGRAM_GLOBAL_INTERVAL, _flood_until)
+        wait = ready - time.monotonic()
+        if wait > 0: await asyncio.sleep(wait)
+        _last_send[chat_id] = _last_send['*'] = time.monotonic()
+
+async def send_text(bot, chat_id, text, **kwargs):
+    """ارسال پیام‌های خودکار (گزارش و خطا) با رعایت محدودیت نرخ؛ بعد از RetryAfter یک بار دوباره تلاش می‌شود"""
+    await telegram_slot(chat_id)
+    try: return await bot.send_message(chat_id=chat_id, text=text, **kwargs)
+    except RetryAfter as e:
+        note_flood(e)
+        await telegram_slot(chat_id)
+        return await bot.send_message(chat_id=chat_id, text=text, **kwargs)
+
+async def fail_upload(bot, item, error):
+    """شکست دائمی: فایل در FAILED_UPLOAD_DIR نگه داشته می‌شود، وضعیت و Baseline سرورها باطل می‌شود
+    تا اجرای بعدی نسخه کامل بفرستد، و مدیر خبردار می‌شود"""
+    UPLOAD_QUEUE.remove(item)
+    os.makedirs(FAILED_UPLOAD_DIR, exist_ok=True)
+    kept = os.path.join(FAILED_UPLOAD_DIR, os.path.basename(item['path']))
+    try: os.replace(item['path'], kept)
+    except OSError: kept = None
+    if item['keys']:
+        state = load_backup_state()
+        for key in item['keys']:
+            state.pop(key, None)
+            server = get_server(key)
+            if server and os.path.exists(baseline_path(server)): os.remove(baseline_path(server))
+        save_backup_state(state)
+    logger.error(f"Upload of {item['filename']} failed permanently after {item['attempts']} attempt(s): {error}")
+    text = f"❌ ارسال {item['filename']} ناموفق ماند ({item['attempts']} تلاش):\n{error}"
+    if kept: text += f"\n💾 فایل در {kept} نگه داشته شد."
+    try: await send_text(bot, item['chat_id'], text)
+    except Exception as e: logger.error(f"Failure report failed for {item['filename']}: {e}")
+
+async def deliver_upload(bot, item):
+    if item['size'] > TELEGRAM_UPLOAD_LIMIT:
+        # تلگرام این فایل را هرگز قبول نمی‌کند؛ تلاش مجدد فقط پهنای باند را هدر می‌دهد
+        await fail_upload(bot, item, f"File too large for Telegram ({format_size(item['size'])} > {format_size(TELEGRAM_UPLOAD_LIMIT)})")
+        save_upload_queue()
+        return
+    await telegram_slot(item['chat_id'])
+    started = time.monotonic()
+    # آرشیو چند سرور با برچسب archive ثبت می‌شود
+    server_id = item['keys'][0] if len(item['keys']) == 1 else 'archive'
+    if not item['attempts']: observe('queue_wait', server_id, max(0.0, time.time() - item['queued_at']))
+    try:
+        with open(item['path'], 'rb') as f:
+            await bot.send_document(chat_id=item['chat_id'], document=f, filename=item['filename'], caption=item['caption'],
+                                    parse_mode=None if item.get('plain') else 'Markdown', read_timeout=UPLOAD_TIMEOUT, write_timeout=UPLOAD_TIMEOUT)
+    except RetryAfter as e:
+        # محدودیت نرخ خطا حساب نمی‌شود؛ فقط زمان تلاش بعدی عقب می‌افتد
+        delay = note_flood(e)
+        item['next_at'] = time.time() + delay
+        logger.warning(f"Flood control: {item['filename']} postponed {delay:.0f}s")
+    except BadRequest as e:
+        if "can't parse entities" in str(e).lower() and not item.get('plain'):
+            # خطای کپشن ربطی به خود فایل ندارد؛ یک بار بدون Markdown دوباره ارسال می‌شود
+            logger.warning(f"Caption of {item['filename']} rejected ({e}); resending as plain text")
+            item['plain'] = True
+            save_upload_queue()
+            return
+        item['attempts'] += 1
+        observe('upload', server_id, time.monotonic() - started, ok=False)
+        await fail_upload(bot, item, str(e))
+    except NetworkError as e:
+        item['attempts'] += 1
+        observe('upload', server_id, time.monotonic() - started, ok=False)
+        # 413 (Request Entity Too Large) با تلاش مجدد درست نمی‌شود
+        if item['attempts'] >= UPLOAD_MAX_ATTEMPTS or '413' in str(e) or 'too large' in str(e).lower(): await fail_upload(bot, item, str(e))
+        else:
+            delay = min(UPLOAD_RETRY_BASE * 2 ** (item['attempts'] - 1), UPLOAD_RETRY_MAX)
+            item['next_at'] = time.time() + delay
+            item['error'] = str(e)
+            logger.warning(f"Upload of {item['filename']} failed ({e}); retry {item['attempts']} in {delay}s")
+    except Exception as e:
+        item['attempts'] += 1
+        observe('upload', server_id, time.monotonic() - started, ok=False)
+        await fail_upload(bot, item, str(e))
+    else:
+        UPLOAD_QUEUE.remove(item)
+        UPLOAD_HISTORY.append((time.time(), item['size'], time.monotonic() - started))
+        observe('upload', server_id, time.monotonic() - started, nbytes=item['size'])
+        try: os.remove(item['path'])
+        except OSError: pass
+    save_upload_queue()
+
+async def upload_worker(bot):
+    """ارسال ترتیبی صف؛ فایل‌هایی که منتظر تلاش مجدد هستند جلوی بقیه را نمی‌گیرند"""
+    while True:
+        now = time.time()
+        due = [item for item in UPLOAD_QUEUE if item['next_at'] <= now]
+        if due:
+            try: await deliver_upload(bot, due[0])
+            except Exception as e:
+                logger.error(f"Upload worker error: {e}")
+                await asyncio.sleep(UPLOAD_RETRY_BASE)
+            continue
+        _upload_wakeup.clear()
+        wait = min((item['next_at'] for item in UPLOAD_QUEUE), default=now + 3600) - now
+        try: await asyncio.wait_for(_upload_wakeup.wait(), timeout=max(wait, 0.1))
+        except asyncio.TimeoutError: pass
+
+def start_upload_worker(bot):
+    global _upload_wakeup, _upload_worker
+    UPLOAD_QUEUE[:] = load_upload_queue()
+    if UPLOAD_QUEUE: logger.info(f"Resuming {len(UPLOAD_QUEUE)} queued upload(s).")
+    _upload_wakeup = asyncio.Event()
+    _upload_worker = asyncio.create_task(upload_worker(bot))
+
+async def stop_upload_worker():
+    if _upload_worker:
+        _upload_worker.cancel()
+        try: await _upload_worker
+        except asyncio.CancelledError: pass
+    save_upload_queue()
+
+def upload_queue_stats():
+    now = time.time()
+    recent = [h for h in UPLOAD_HISTORY if now - h[0] < 3600]
+    busy = sum(h[2] for h in recent)
+    return {'depth': len(UPLOAD_QUEUE), 'bytes': sum(item['size'] for item in UPLOAD_QUEUE),
+            'retrying': sum(1 for item in UPLOAD_QUEUE if item['attempts'] or item['next_at'] > now),
+            'sent_hour': len(recent), 'rate': sum(h[1] for h in recent) / busy if busy else 0}
+
+def format_upload_queue():
+    stats = upload_queue_stats()
+    if not stats['depth'] and not stats['sent_hour']: return ""
+    text = f"📤 **صف ارسال:** {stats['depth']} فایل ({format_size(stats['bytes'])})"
+    if stats['retrying']: text += f" — {stats['retrying']} در انتظار تلاش مجدد"
+    if stats['sent_hour']: text += f"\n🚚 ساعت اخیر: {stats['sent_hour']} فایل با سرعت {format_size(stats['rate'])}/ثانیه"
+    return text + "\n\n"
+
+async def queue_command(update, context):
+    """/queue — وضعیت صف ارسال"""
+    if not check_auth(update.effective_user.id): return
+    lines = [format_upload_queue().strip() or "📤 صف ارسال خالی است."]
+    for item in UPLOAD_QUEUE[:10]:
+        status = f"تلاش {item['attempts']}" if item['attempts'] else "در انتظار"
+        if item['next_at'] > time.time(): status += f"، بعدی تا {int(item['next_at'] - time.time())} ثانیه دیگر"
+        lines.append(f"• {escape_markdown(item['filename'])} ({format_size(item['size'])}) — {status}")
+    if len(UPLOAD_QUEUE) > 10: lines.append(f"• ... و {len(UPLOAD_QUEUE) - 10} فایل دیگر")
+    await update.message.reply_text("\n".join(lines), parse_mode='Markdown')
+
 # --- بکاپ ---
-async def run_backup_task(context, chat_id=None):
+_backup_slots = None
+
+def backup_slots():
+    """سقف BACKUP_CONCURRENCY برای کل ربات؛ واحدهای زمان‌بندی هم‌زمان هم از همین سقف مشترک استفاده می‌کنند"""
+    global _backup_slots
+    if _backup_slots is None: _backup_slots = asyncio.Semaphore(BACKUP_CONCURRENCY)
+    return _backup_slots
+
+async def wait_for_progress(coro, info, timeout):
+    """مثل asyncio.wait_for ولی سقف زمان از آخرین پیشرفت دانلود (info['transfer']['active']) حساب می‌شود؛
+    پس دیتابیس بزرگ روی لینک کند تا وقتی داده می‌رسد قطع نمی‌شود و فقط دانلود متوقف‌شده رها می‌شود"""
+    task = asyncio.ensure_future(coro)
+    started = time.monotonic()
+    try:
+        while True:
+            active = max(started, info.get('transfer', {}).get('active', 0))
+            remaining = timeout - (time.monotonic() - active)
+            if remaining <= 0: raise asyncio.TimeoutError
+            done, _ = await asyncio.wait({task}, timeout=remaining)
+            if done: return task.result()
+    finally:
+        if not task.done():
+            task.cancel()
+            try: await task
+            except asyncio.CancelledError: pass
+
+async def backup_single_server(context, chat_id, server, state, force=False, delivery='file', backup_mode='full', delay=0):
+    """بکاپ یک سرور با سقف هم‌زمانی؛ در حالت تکی آپلود بلافاصله بعد از پایان دانلود انجام می‌شود
+    و در حالت آرشیو فایل برای فشرده‌سازی گروهی نگه داشته می‌شود.
+    اگر دیتابیس با آخرین نسخه آپلودشده یکسان باشد (و force نباشد) آپلود نمی‌شود.
+    سرورهایی که مدارشان باز است (Circuit Breaker) بدون تلاش رد می‌شوند.
+    delay: چند ثانیه صبر قبل از شروع (پخش کردن شروع سرورهای یک واحد زمان‌بندی)"""
+    if delay: await asyncio.sleep(delay)
+    if not circuit_allows(server): return {'status': 'skipped', 'path': None}
+    async with backup_slots():
+        info = {}
+        try:
+            filepath, res = await wait_for_progress(perform_backup_async(server, mode='backup', info=info), info, BACKUP_SERVER_TIMEOUT)
+        except asyncio.TimeoutError:
+            filepath, res = None, f"Timeout (no progress for {BACKUP_SERVER_TIMEOUT}s)"
+        except Exception as e:
+            filepath, res = None, str(e)
+    record_result(server, bool(filepath))
+
+    if not filepath:
+        try: await send_text(context.bot, chat_id, f"❌ خطا {server['name']}:\n{res}")
+        except Exception as e: logger.error(f"Error report failed for {server['name']}: {e}")
+        return {'status': 'failed', 'path': None}
+
+    result = {'status': 'failed', 'path': res, 'panel_version': info.get('panel_version'), 'files': [filepath]}
+    try:
+        digest = await asyncio.to_thread(file_digest, filepath)
+        size = os.path.getsize(filepath)
+        now_ts = time.time()
+        rows = [(server['id'], now_ts, 'backup_size', size)]
+        if 'login' in info: rows.append((server['id'], now_ts, 'login_latency', info['login']))
+        if 'download' in info: rows.append((server['id'], now_ts, 'download_latency', info['download']))
+        await record_metrics(rows)
+        last = state.get(server_key(server), {})
+        if not force and last.get('sha256') == digest and last.get('size') == size:
+            result['status'] = 'unchanged'
+            return result
+
+        # دیتابیس ناقص یا خراب (با وجود هدر درست) به‌عنوان بکاپ موفق ارسال نمی‌شود
+        verify_started = time.monotonic()
+        summary = await run_verify(filepath)
+        observe('verify', server_key(server), time.monotonic() - verify_started, ok=summary['ok'])
+        if not summary['ok']:
+            logger.error(f"Integrity check failed for {server['name']}: {summary['error']}")
+            try: await send_text(context.bot, chat_id, f"❌ دیتابیس {server['name']} سالم نیست (quick_check):\n{summary['error']}")
+            except Exception as e: logger.error(f"Error report failed for {server['name']}: {e}")
+            return result
+        summary.pop('ok')
+        if summary['clients'] is not None: await record_metrics([(server['id'], now_ts, 'clients', summary['clients'])])
+        drop = client_drop(last.get('summary'), summary)
+        if drop:
+            try: await send_text(context.bot, chat_id, f"⚠️ **هشدار {escape_markdown(server['name'])}:** تعداد کاربران از {drop[0]} به {drop[1]} کاهش یافت.", parse_mode='Markdown')
+            except Exception as e: logger.error(f"Client drop alert failed for {server['name']}: {e}")
+        if SNAPSHOT_STORE:
+            try: await run_snapshots(add_snapshot_sync, server['id'], filepath, digest, now_ts)
+            except Exception as e: logger.error(f"Snapshot failed for {server['name']}: {e}")
+
+        now = datetime.now()
+        upload = {'filepath': filepath, 'name': backup_file_name(server), 'kind': 'full', 'chain': 0}
+        if backup_mode == 'incremental':
+            # دکمه بکاپ آنی (force) همیشه یک نسخه کامل می‌فرستد و زنجیره را از نو شروع می‌کند
+            if not force: upload = await prepare_incremental(server, filepath, size, last, now)
+            result['baseline'] = filepath
+        if upload['filepath'] != filepath: result['files'].append(upload['filepath'])
+        upload['summary'] = summary
+        result['upload'] = upload
+        result['record'] = {'sha256': digest, 'size': size, 'uploaded_at': now.isoformat(timespec='seconds'), 'chain': upload['chain'], 'summary': summary}
+        if delivery == 'archive':
+            result['status'] = 'pending'
+            return result
+
+        # در حالت افزایشی نسخه کامل دانلودشده Baseline بعدی هم هست، پس برای صف فقط لینک/کپی ساخته می‌شود
+        enqueue_upload(chat_id, upload['filepath'], backup_caption(server, upload, now), filename=upload['name'],
+                       keys=[server_key(server)], keep_source=upload['filepath'] == result.get('baseline'))
+        result['status'] = 'queued'
+        return result
+    except Exception as e:
+        logger.error(f"Queueing upload failed for {server['name']}: {e}")
+        result['status'] = 'failed'
+        return result
+    finally:
+        if result['status'] != 'pending': finish_backup(server, result, state, result['status'] == 'queued')
+
+async def deliver_archives(context, chat_id, pending, state):
+    """فشرده‌سازی همه فایل‌های این اجرا در یک یا چند آرشیو زیر سقف تلگرام و قرار دادن آن‌ها در صف ارسال"""
+    now = datetime.now()
+    used = set()
+    items = [(unique_arcname(r['upload']['name'], used), r['upload']['filepath']) for _, r in pending]
+    by_arcname = {name: entry for (name, _), entry in zip(items, pending)}
+    # هر اجرا پوشه موقت خودش را دارد تا آرشیو اجراهای هم‌زمان (واحدهای زمان‌بندی مختلف) روی هم نیفتند
+    out_dir = tempfile.mkdtemp(dir=BACKUP_DIR, prefix='archive_')
+    try:
+        archives = await create_archives(items, now.strftime('%Y-%m-%d_%H%M%S'), out_dir)
+    except Exception as e:
+        logger.error(f"Archive build failed: {e}")
+        archives = []
+
+    delivered = set()
+    for index, (names, paths) in enumerate(archives, 1):
+        names_text = "، ".join(escape_markdown(by_arcname[n][0]['name']) for n in names)
+        ok = True
+        for part_no, path in enumerate(paths, 1):
+            part_text = f" (تکه {part_no}/{len(paths)})" if len(paths) > 1 else ""
+            caption = f"🗜 **آرشیو بکاپ {index}/{len(archives)}**{part_text}\n📅 {now.strftime('%Y-%m-%d')}\n⏰ {now.strftime('%H:%M:%S')}\n🗂 {names_text}"[:1024]
+            try:
+                # اگر یک تکه در صف قرار نگرفت، بقیه تکه‌های همان آرشیو بی‌فایده‌اند
+                if ok: enqueue_upload(chat_id, path, caption, keys=[server_key(by_arcname[n][0]) for n in names])
+            except Exception as e:
+                logger.error(f"Queueing archive failed ({os.path.basename(path)}): {e}")
+                ok = False
+        if ok: delivered.update(names)
+
+    shutil.rmtree(out_dir, ignore_errors=True)
+    for name, (server, result) in by_arcname.items():
+        result['status'] = 'queued' if name in delivered else 'failed'
+        finish_backup(server, result, state, name in delivered)
+
+async def run_backup_task(context, chat_id=None, force=False, server_ids=None, spread=0):
+    """spread: شروع هر سرور با تاخیر ثابت (بر اساس هش شناسه) در این بازه پخش می‌شود"""
     if not chat_id: chat_id = int(config.ADMIN_ID)
-    servers = load_servers()
+    servers = [s for s in all_servers() if server_ids is None or s['id'] in server_ids]
     if not servers: return
-    for server in servers:
-        filepath, res = await perform_backup_async(server, mode='backup')
-        if filepath:
-            if server.get('db_path') != res:
-                server['db_path'] = res
-                save_servers(servers)
-            try:
-                now = datetime.now()
-                caption = f"📦 **{server['name']}**\n📅 {now.strftime('%Y-%m-%d')}\n⏰ {now.strftime('%H:%M:%S')}"
-                with open(filepath, 'rb') as f: await context.bot.send_document(chat_id=chat_id, document=f, caption=caption, parse_mode='Markdown')
-                os.remove(filepath)
-            except: pass
-        else: await context.bot.send_message(chat_id=chat_id, text=f"❌ خطا {server['name']}:\n{res}")
+    # سرورهایی که بکاپ قبلی‌شان هنوز تمام نشده در این اجرا رد می‌شوند (بدون هم‌پوشانی)
+    busy = [s for s in servers if s['id'] in BACKUP_RUNNING]
+    if busy: logger.info(f"Skipping {len(busy)} server(s) with a backup still running.")
+    servers = [s for s in servers if s['id'] not in BACKUP_RUNNING]
+    if not servers: return
+    claimed = {s['id'] for s in servers}
+    BACKUP_RUNNING.update(claimed)
+    begin_run_stages(claimed)
+    run_started = time.time()
+    try:
+        started = time.monotonic()
+        state = load_backup_state()
+        settings = load_settings()
+        tasks = [backup_single_server(context, chat_id, s, state, force=force, delivery=settings['delivery'], backup_mode=settings['backup_mode'],
+                                      delay=jitter(s['id'], spread) if spread else 0) for s in servers]
+        results = await asyncio.gather(*tasks)
+        pending = [(s, r) for s, r in zip(servers, results) if r['status'] == 'pending']
+        if pending: await deliver_archives(context, chat_id, pending, state)
+    finally:
+        BACKUP_RUNNING.difference_update(claimed)
 
-async def scheduled_backup(context):
-    chat_id = context.job.chat_id if context.job.chat_id else int(config.ADMIN_ID)
-    await run_backup_task(context, chat_id=chat_id)
+    # مسیر جدید روی نسخه فعلی رجیستری ثبت می‌شود تا ویرایش‌های هم‌زمان از بین نروند
+    for server, result in zip(servers, results):
+        current = get_server(server['id'])
+        if not current or not result['path']: continue
+        changes = {'db_path': result['path']}
+        if result.get('panel_version'): changes['panel_version'] = result['panel_version']
+        elif current.get('db_path') != result['path']: changes['panel_version'] = None
+        if any(current.get(k) != v for k, v in changes.items()): update_server(server['id'], **changes)
+
+    counts = {'queued': 0, 'unchanged': 0, 'failed': 0, 'skipped': len(busy)}
+    for result in results: counts[result['status']] += 1
+    elapsed = time.monotonic() - started
+    finish_run_stages(claimed, run_started, elapsed)
+    logger.info(f"Backup run finished: {counts} in {elapsed:.1f}s")
+    # اگر چیزی آپلود نشده و خطایی هم نبوده، پیام اضافه‌ای به چت ارسال نمی‌شود؛
+    # برای اجرای تک‌سروری هم پیام فایل/خطا کافی است
+    if not force and counts['queued'] == 0 and counts['failed'] == 0: return
+    if not force and len(servers) + len(busy) == 1: return
+    try:
+        await send_text(
+            context.bot, chat_id,
+            f"📊 **گزارش بکاپ**\n✅ موفق (در صف ارسال): {counts['queued']}\n♻️ بدون تغییر: {counts['unchanged']}\n❌ ناموفق: {counts['failed']}\n⏸ رد شده (مدار باز/در حال اجرا): {counts['skipped']}\n🗂 کل: {len(servers) + len(busy)}\n⏱ زمان کل: {elapsed:.1f} ثانیه\n\n{format_upload_queue()}".strip(),
+            parse_mode='Markdown'
+        )
+    except Exception as e: logger.error(f"Summary send failed: {e}")
 
 async def export_config_logic(update, context, chat_id):
     await context.bot.send_message(chat_id=chat_id, text="📥 ارسال فایل‌های تنظیمات...")
+    flush_servers()
     try:
         for f_name in ["config.py", DATA_FILE, SETTINGS_FILE]:
             if os.path.exists(f_name):
@@ -342,9 +2190,11 @@ async def add_pass(update, context):
     temp = {'name': context.user_data['name'], 'url': context.user_data['url'], 'username': context.user_data['username'], 'password': password}
     msg = await update.message.reply_text("⏳ تست اتصال (4 ثانیه)...", reply_markup=ReplyKeyboardRemove())
     
-    fp, res = await perform_backup_async(temp, mode='test') 
+    info = {}
+    fp, res = await perform_backup_async(temp, mode='test', info=info) 
     if fp:
-        os.remove(fp); temp['db_path'] = res; servers = load_servers(); servers.append(temp); save_servers(servers)
+        os.remove(fp); temp['db_path'] = res; temp['panel_version'] = info.get('panel_version'); add_server(temp)
+        reschedule_backups(context.application)
         await safe_reply(update, context, msg, f"✅ سرور اضافه شد.", parse_mode='Markdown')
     else:
         await safe_reply(update, context, msg, f"❌ خطا:\n{res}")
@@ -357,14 +2207,12 @@ async def edit_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not check_auth(query.from_user.id): return ConversationHandler.END
     
     try:
-        idx = int(query.data.split('_')[2])
-        servers = load_servers()
-        if not (0 <= idx < len(servers)):
+        server = get_server(query.data.split('_', 2)[2])
+        if not server:
             await query.edit_message_text("❌ سرور یافت نشد.")
             return ConversationHandler.END
             
-        context.user_data['edit_idx'] = idx
-        server = servers[idx]
+        context.user_data['edit_id'] = server['id']
         
         await query.message.reply_text(
             f"✏️ ویرایش سرور **{server['name']}**\n\n1️⃣ لطفاً **یوزرنیم جدید** را ارسال کنید:",
@@ -384,14 +2232,10 @@ async def edit_receive_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def edit_receive_pass(update: Update, context: ContextTypes.DEFAULT_TYPE):
     new_password = update.message.text
     new_username = context.user_data.get('edit_username')
-    idx = context.user_data.get('edit_idx')
-    
-    servers = load_servers()
-    if idx is None or not (0 <= idx < len(servers)):
+    server = get_server(context.user_data.get('edit_id'))
+    if not server:
         await update.message.reply_text("❌ خطا: سرور در این فاصله حذف شده است.", reply_markup=ReplyKeyboardRemove())
         return ConversationHandler.END
-
-    server = servers[idx]
     
     temp_server = server.copy()
     temp_server['username'] = new_username
@@ -399,16 +2243,16 @@ async def edit_receive_pass(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     msg = await update.message.reply_text("⏳ در حال تست اتصال (4 ثانیه)...", reply_markup=ReplyKeyboardRemove())
     
-    filepath, res = await perform_backup_async(temp_server, mode='test')
+    info = {}
+    filepath, res = await perform_backup_async(temp_server, mode='test', info=info)
     
     if filepath:
         os.remove(filepath)
-        server['username'] = new_username
-        server['password'] = new_password
-        if server.get('db_path') != res: server['db_path'] = res
-        
-        servers[idx] = server
-        save_servers(servers)
+        changes = {'username': new_username, 'password': new_password, 'db_path': res}
+        if info.get('panel_version'): changes['panel_version'] = info['panel_version']
+        if not update_server(server['id'], **changes):
+            await safe_reply(update, context, msg, "❌ خطا: سرور در این فاصله حذف شده است.")
+            return ConversationHandler.END
         
         await safe_reply(update, context, msg, f"✅ اطلاعات سرور **{server['name']}** با موفقیت ویرایش شد.", parse_mode='Markdown')
         await show_menu(update, context)
@@ -420,17 +2264,31 @@ async def edit_receive_pass(update: Update, context: ContextTypes.DEFAULT_TYPE):
     return ConversationHandler.END
 
 # --- راه‌اندازی ربات ---
+async def post_shutdown(application: Application):
+    await stop_upload_worker()
+    await stop_metrics_server()
+    shutdown_verify_executor()
+    flush_servers()
+    await close_http_transport()
+
 async def post_init(application: Application):
-    commands = [("start", "🏠 منوی اصلی"), ("add", "➕ افزودن سرور"), ("export", "📤 بکاپ تنظیمات")]
+    commands = [("start", "🏠 منوی اصلی"), ("add", "➕ افزودن سرور"), ("export", "📤 بکاپ تنظیمات"),
+                ("trend", "📈 روند CPU/RAM یک سرور"), ("slowest", "🐢 کندترین پنل‌ها"),
+                ("schedule", "⏱ زمان‌بندی هر سرور/گروه"), ("group", "👥 تعیین گروه سرور"), ("queue", "📤 وضعیت صف ارسال"),
+                ("snapshot", "🗄 دریافت Snapshot ذخیره‌شده"), ("stats", "⏱ آمار مراحل آخرین بکاپ")]
     await application.bot.set_my_commands(commands)
+    start_upload_worker(application.bot)
+    await start_metrics_server()
 
 def main():
-    defaults = Defaults(tzinfo=pytz.timezone('Asia/Tehran'))
-    app = Application.builder().token(config.BOT_TOKEN).defaults(defaults).post_init(post_init).build()
+    defaults = Defaults(tzinfo=TIMEZONE)
+    app = Application.builder().token(config.BOT_TOKEN).defaults(defaults).post_init(post_init).post_shutdown(post_shutdown).build()
     
-    settings = load_settings()
-    initial_interval = settings.get("interval", 86400)
-    app.job_queue.run_repeating(scheduled_backup, interval=initial_interval, first=initial_interval, name='backup_job', chat_id=int(config.ADMIN_ID))
+    ensure_registry()
+    reschedule_backups(app)
+    app.job_queue.run_repeating(monitor_job, interval=MONITOR_INTERVAL, first=5, name='monitor_job')
+    app.job_queue.run_repeating(metrics_rollup_job, interval=3600, first=60, name='metrics_rollup_job')
+    if SNAPSHOT_STORE: app.job_queue.run_repeating(snapshot_prune_job, interval=3600, first=120, name='snapshot_prune_job')
 
     back_filter = filters.Regex(f"^{BACK_BTN_TEXT}$")
     
@@ -459,8 +2317,29 @@ def main():
     app.add_handler(CallbackQueryHandler(button_handler))
     app.add_handler(CommandHandler("start", lambda u,c: show_menu(u,c) if check_auth(u.effective_user.id) else None))
     app.add_handler(CommandHandler("export", export_command_handler))
+    app.add_handler(CommandHandler("trend", trend_command))
+    app.add_handler(CommandHandler("slowest", slowest_command))
+    app.add_handler(CommandHandler("schedule", schedule_command))
+    app.add_handler(CommandHandler("group", group_command))
+    app.add_handler(CommandHandler("queue", queue_command))
+    app.add_handler(CommandHandler("snapshot", snapshot_command))
+    app.add_handler(CommandHandler("stats", stats_command))
     
     print(f"Bot V18 Started. Bulletproof.")
     app.run_polling()
 
-if __name__ == '__main__': main()
+def restore_command(args):
+    """python main.py restore <full.db> [delta1.xdelta ...] <output.db>"""
+    if len(args) < 2:
+        print("Usage: python main.py restore <full.db> [delta1.xdelta delta2.xdelta ...] <output.db>")
+        return
+    try:
+        restore_backup_chain(args[0], args[1:-1], args[-1])
+        print(f"✅ Restored {len(args) - 2} delta(s) into {args[-1]}")
+    except Exception as e:
+        print(f"❌ Restore failed: {e}")
+        exit(1)
+
+if __name__ == '__main__':
+    if OFFLINE_RESTORE: restore_command(sys.argv[2:])
+    else: main()